@@ -3,26 +3,26 @@
 from flask import Flask, render_template, url_for, redirect, request, g, jsonify, session
 from depicts import (utils, wdqs, commons, mediawiki, artwork, database,
                      wd_catalog, human, wikibase, wikidata_oauth, wikidata_edit, mail,
-                     fixtures)
+                     fixtures, query_log, http_client, entity_cache,
+                     label_store, fanout, scheduler, image_cache, prefetch,
+                     bitmap_index)
 from depicts.pager import Pagination, init_pager
 from depicts.model import (DepictsItem, DepictsItemAltLabel, Edit, Item,
-                           Language, WikidataQuery, Triple)
+                           Language, WikidataQuery, Triple, FacetCount)
 from depicts.error_mail import setup_error_mail
 from requests_oauthlib import OAuth1Session
 from werkzeug.exceptions import InternalServerError
 from werkzeug.debug.tbtools import get_current_traceback
-from sqlalchemy import func, distinct
-from sqlalchemy.orm import aliased
+from sqlalchemy import func, distinct, case, select
+from sqlalchemy.orm import aliased, defer
 from sqlalchemy.sql.expression import desc
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 import simplejson.errors
-import requests.exceptions
 import inspect
 import itertools
-import hashlib
+import threading
 import json
-import os
 import locale
 import socket
 import re
@@ -30,9 +30,25 @@ import re
 locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
 user_agent = 'Mozilla/5.0 (X11; Linux i586; rv:32.0) Gecko/20160101 Firefox/32.0'
 
+# the facet_count table is rebuilt in the background once it is this old
+facet_count_max_age = timedelta(hours=1)
+facet_count_lock_id = 0x666163  # postgres advisory lock key
+facet_count_refreshing = threading.Lock()
+
 app = Flask(__name__)
 app.config.from_object('config.default')
 database.init_db(app.config['DB_URL'])
+wdqs.init_app(app)
+http_client.init_app(app)
+scheduler.init_app(app)
+mediawiki.init_app(app)
+entity_cache.init_app(app)
+image_cache.init_app(app)
+prefetch.init_app(app)
+bitmap_index.init_app(app)
+commons.init_app(app)
+utils.catalog_base_url = app.config.get('CATALOG_BASE_URL')
+query_log.init_app(app)
 init_pager(app)
 setup_error_mail(app)
 
@@ -218,13 +234,10 @@ def property_query_page(property_id):
     sort = request.args.get('sort')
     sort_by_name = sort and sort.lower().strip() == 'name'
 
-    q = (database.session.query(Triple.object_id,
-                                func.count(func.distinct(Triple.subject_id)).label('c'))
+    check_facet_counts()
+    q = (database.session.query(FacetCount.object_id, FacetCount.count)
                          .filter_by(predicate_id=property_id)
-                         .join(Item, Item.item_id == Triple.subject_id)
-                         .filter_by(is_artwork=True)
-                         .group_by(Triple.object_id)
-                         .order_by(desc('c')))
+                         .order_by(FacetCount.count.desc()))
 
     page = utils.get_int_arg('page') or 1
     total = q.count()
@@ -256,20 +269,20 @@ def start():
 
 @app.route('/next')
 def random_artwork():
-    found = None
-    while True:
-        q = Item.query.filter_by(is_artwork=True).order_by(func.random()).limit(30)
-        for item in q:
-            has_depicts = 'P180' in item.entity['claims']
-            if has_depicts:
-                continue
-            found = item
-            break
-        if found:
-            break
-
-    session[found.qid] = 'from redirect'
-    return redirect(url_for('item_page', item_id=found.item_id))
+    q = database.session.query(Item.item_id).filter_by(is_artwork=True)
+    item_id = q.filter_by(has_depicts=False).order_by(func.random()).limit(1).scalar()
+    if item_id is None:
+        # has_depicts is null for items saved before set-item-columns has run
+        item_id = (q.filter(Item.has_depicts.is_(None),
+                            ~Item.entity['claims'].has_key('P180'))
+                    .order_by(func.random())
+                    .limit(1)
+                    .scalar())
+    if item_id is None:
+        return redirect(url_for('browse_page'))
+
+    session[f'Q{item_id}'] = 'from redirect'
+    return redirect(url_for('item_page', item_id=item_id))
 
 @app.route('/oauth/start')
 def start_oauth():
@@ -345,18 +358,11 @@ def create_claim(artwork_id, depicts_id, token):
     }
     return wikidata_oauth.api_post_request(params)
 
-def image_with_cache(qid, image_filename, width):
-    filename = f'cache/{qid}_{width}_image.json'
-    detail = json.load(open(filename)) if os.path.exists(filename) else {}
-
+def image_with_cache(image_filename, width):
+    if not image_filename:
+        return
     image_filename = image_filename.replace('_', ' ')
-
-    # The image associated with an item can change.
-    # If that happens the detail in the cache will be for the wrong file.
-    if not detail or image_filename not in detail:
-        detail = commons.image_detail([image_filename], thumbwidth=width)
-        json.dump(detail, open(filename, 'w'), indent=2)
-
+    detail = commons.image_detail_with_cache([image_filename], thumbwidth=width)
     return detail.get(image_filename)
 
 def existing_depicts_from_entity(entity):
@@ -401,9 +407,14 @@ def get_institution(entity, other):
 def item_page(item_id):
     qid = f'Q{item_id}'
     g.qid = qid
-    item = artwork.Artwork(qid)
     from_redirect = qid in session and session.pop(qid) == 'from redirect'
-    entity = mediawiki.get_entity_with_cache(qid, refresh=not from_redirect)
+    artwork_item = Item.query.get(item_id)
+    if from_redirect:
+        entity = mediawiki.get_entity_with_cache(qid)
+    else:
+        stored = artwork_item.entity if artwork_item else None
+        entity = mediawiki.get_current_entity(qid, stored=stored)
+    item = artwork.Artwork(qid)
 
     if 'redirects' in entity:
         redirect_to_item_id = int(entity['redirects']['to'][1:])
@@ -411,13 +422,6 @@ def item_page(item_id):
 
     existing_depicts = existing_depicts_from_entity(entity)
 
-    width = 800
-    image_filename = item.image_filename
-    if image_filename:
-        image = image_with_cache(qid, image_filename, width)
-    else:
-        image = None
-
     # hits = item.run_query()
     label_and_language = get_entity_label_and_language(entity)
     if label_and_language:
@@ -425,17 +429,24 @@ def item_page(item_id):
     else:
         label = None
     g.label = label
-    other = get_other(item.entity)
 
-    people = human.from_name(label) if label else None
+    # these upstream calls are independent, run them at the same time
+    width = 800
+    calls = [
+        (image_with_cache, item.image_filename, width),
+        (get_other, item.entity),
+        (human.from_name, label) if label else (list,),
+    ]
+    if artwork_item is not None:
+        calls.append((wd_catalog.get_catalog_from_artwork, entity))
+    image, other, people, *catalog = fanout.run(*calls)
 
     label_languages = label_and_language['languages'] if label_and_language else []
     show_translation_links = all(lang.code != 'en' for lang in label_languages)
 
-    artwork_item = Item.query.get(item_id)
     if artwork_item is None:
 
-        if not wdqs.is_artificial_physical_object(qid):
+        if not wdqs.is_artificial_physical_object(entity):
             return render_template('not_artwork.html',
                            qid=qid,
                            item_id=item_id,
@@ -457,8 +468,13 @@ def item_page(item_id):
                             lastrevid=entity['lastrevid'],
                             modified=modified)
         database.session.add(artwork_item)
+    elif 'lastrevid' in entity and artwork_item.lastrevid != entity['lastrevid']:
+        artwork_item.entity = entity
+        artwork_item.lastrevid = entity['lastrevid']
+        artwork_item.modified = datetime.strptime(entity['modified'], "%Y-%m-%dT%H:%M:%SZ")
+    database.session.commit()
 
-    catalog = wd_catalog.get_catalog_from_artwork(entity)
+    catalog = catalog[0] if catalog else wd_catalog.get_catalog_from_artwork(entity)
     if not catalog.get('institution'):
         catalog['institution'] = get_institution(entity, other)
 
@@ -506,63 +522,8 @@ def get_entity_label_and_language(entity):
         return {'label': label,
                 'languages': get_languages(languages)}
 
-def get_labels(keys, name=None):
-    keys = sorted(keys, key=lambda i: int(i[1:]))
-    if name is None:
-        name = hashlib.md5('_'.join(keys).encode('utf-8')).hexdigest()
-    filename = f'cache/{name}_labels.json'
-    labels = []
-    if os.path.exists(filename):
-        from_cache = json.load(open(filename))
-        if isinstance(from_cache, dict) and from_cache.get('keys') == keys:
-            labels = from_cache['labels']
-    if not labels:
-        for cur in utils.chunk(keys, 50):
-            labels += mediawiki.get_entities(cur, props='labels')
-
-        json.dump({'keys': keys, 'labels': labels},
-                  open(filename, 'w'), indent=2)
-
-    return {entity['id']: wikibase.get_entity_label(entity) for entity in labels}
-
 def get_labels_db(keys):
-    keys = set(keys)
-    labels = {}
-    missing = set()
-    for qid in keys:
-        m = re_qid.match(qid)
-        if m:
-            item_id = int(m.group(1))
-            item = Item.query.get(item_id)
-            if item:
-                labels[qid] = item.label
-                continue
-
-        missing.add(qid)
-
-    page_size = 50
-    try:
-        for cur in utils.chunk(missing, page_size):
-            for entity in mediawiki.get_entities(cur):
-                if 'redirects' in entity:
-                    continue
-
-                qid = entity['id']
-
-                modified = datetime.strptime(entity['modified'], "%Y-%m-%dT%H:%M:%SZ")
-                # FIXME: check if the item is an artwork and set is_artwork correctly
-                item = Item(item_id=qid[1:],
-                            entity=entity,
-                            lastrevid=entity['lastrevid'],
-                            modified=modified,
-                            is_artwork=False)
-                database.session.add(item)
-                labels[qid] = item.label
-            database.session.commit()
-    except requests.exceptions.ReadTimeout:
-        pass
-
-    return labels
+    return label_store.get_labels(set(keys))
 
 def build_other_set(entity):
     other_items = set()
@@ -575,7 +536,7 @@ def build_other_set(entity):
 
 def get_other(entity):
     other_items = build_other_set(entity)
-    return get_labels(other_items)
+    return label_store.get_labels(other_items)
 
 @app.route("/edits")
 def list_edits():
@@ -621,10 +582,10 @@ def next_page(item_id):
 
     width = 800
     image_filename = wikibase.first_datavalue(entity, 'P18')
-    image = image_with_cache(qid, image_filename, width)
+    image, other = fanout.run((image_with_cache, image_filename, width),
+                              (get_other, entity))
 
     label = wikibase.get_entity_label(entity)
-    other = get_other(entity)
 
     other_list = []
     for key, prop_label in find_more_props.items():
@@ -691,32 +652,6 @@ def tool_info():
     }
     return jsonify(info)
 
-def get_facets(params):
-    properties = [pid for pid in find_more_props.keys()
-                  if pid not in request.args]
-
-    bindings = wdqs.run_from_template_with_cache('query/facet.sparql',
-                                                 params=params,
-                                                 isa_list=isa_list,
-                                                 properties=properties)
-
-    facets = {key: [] for key in find_more_props.keys()}
-    for row in bindings:
-        pid = row['property']['value'].rpartition('/')[2]
-        qid = row['object']['value'].rpartition('/')[2]
-        label = row['objectLabel']['value']
-        count = int(row['count']['value'])
-
-        if pid not in find_more_props:
-            continue
-        facets[pid].append({'qid': qid, 'label': label, 'count': count})
-
-    return {
-        key: sorted(values, key=lambda i: i['count'], reverse=True)[:15]
-        for key, values in facets.items()
-        if values
-    }
-
 def get_artwork_params():
     params = []
     for pid, qid in request.args.items():
@@ -734,16 +669,15 @@ def get_artwork_params():
     return params
 
 def filter_artwork(params):
-    return wdqs.run_from_template_with_cache('query/find_more.sparql',
-                                             params=params,
-                                             isa_list=isa_list)
+    ''' bindings for artworks matching params, read one at a time '''
+    return wdqs.stream_from_template_with_cache('query/find_more.sparql',
+                                                params=params,
+                                                isa_list=isa_list)
 
 @app.route('/catalog')
 def catalog_page():
     params = get_artwork_params()
     bindings = filter_artwork(params)
-    page = utils.get_int_arg('page') or 1
-    page_size = 45
 
     item_ids = set()
     for row in bindings:
@@ -771,19 +705,17 @@ def catalog_page():
         }
         items.append(item)
 
-    other = get_labels(other_items)
+    other = label_store.get_labels(other_items)
 
-    flat = '_'.join(f'{pid}={qid}' for pid, qid in params)
     thumbwidth = 400
-    # FIXME cache_name can be too long for filesystem
-    cache_name = f'{flat}_{page}_{page_size}_{thumbwidth}'
-    detail = get_image_detail_with_cache(items, cache_name, thumbwidth=thumbwidth)
+    detail = commons.image_detail_with_cache([item['image_filename'] for item in items],
+                                             thumbwidth=thumbwidth)
 
     for item in items:
         item['url'] = url_for('item_page', item_id=item['item_id'])
         item['image'] = detail[item['image_filename']]
 
-    item_labels = get_labels(qid for pid, qid in params)
+    item_labels = label_store.get_labels(qid for pid, qid in params)
     title = ' / '.join(find_more_props[pid] + ': ' + item_labels[qid]
                        for pid, qid in params)
 
@@ -793,35 +725,86 @@ def catalog_page():
                            other=other,
                            title=title)
 
-def get_image_detail_with_cache(items, cache_name, thumbwidth=None, refresh=False):
-    filenames = [cur.image_filename() for cur in items]
-
-    if thumbwidth is None:
-        thumbwidth = app.config['THUMBWIDTH']
+def refresh_facet_counts():
+    '''
+    rebuild the facet_count table from triple in one transaction
 
-    filename = f'cache/{cache_name}_images.json'
-    cache_exists = os.path.exists(filename)
-    detail = None
-    if not refresh and cache_exists:
-        try:
-            detail = json.load(open(filename))
-        except json.decoder.JSONDecodeError:
-            pass
-    if not detail:
-        try:
-            detail = commons.image_detail(filenames, thumbwidth=thumbwidth)
-            json.dump(detail, open(filename, 'w'), indent=2)
-        except requests.exceptions.ReadTimeout:
-            detail = json.load(open(filename)) if cache_exists else {}
+    Returns False without doing anything if another process is rebuilding it.
+    '''
+    lock = func.pg_try_advisory_xact_lock(facet_count_lock_id)
+    if not database.session.execute(select([lock])).scalar():
+        database.session.rollback()
+        return False
+
+    counts = (database.session.query(Triple.predicate_id,
+                                     Triple.object_id,
+                                     func.count(distinct(Triple.subject_id)),
+                                     database.now_utc())
+                              .join(Item, Triple.subject_id == Item.item_id)
+                              .filter_by(is_artwork=True)
+                              .group_by(Triple.predicate_id, Triple.object_id))
+
+    FacetCount.query.delete()
+    insert = FacetCount.__table__.insert()
+    database.session.execute(insert.from_select(['predicate_id', 'object_id', 'count', 'updated'],
+                                                counts.statement))
+    database.session.commit()
+    return True
 
-    return detail
+def refresh_facet_counts_thread():
+    try:
+        refresh_facet_counts()
+    finally:
+        database.session.remove()
+        facet_count_refreshing.release()
+
+def check_facet_counts():
+    ''' start a background rebuild of the facet counts when they are missing or old '''
+    updated = database.session.query(FacetCount.updated).limit(1).scalar()
+    if updated and datetime.utcnow() - updated < facet_count_max_age:
+        return
+    if facet_count_refreshing.acquire(blocking=False):
+        threading.Thread(target=refresh_facet_counts_thread, daemon=True).start()
+
+@app.cli.command('refresh-facet-counts')
+def refresh_facet_counts_command():
+    if not refresh_facet_counts():
+        print('facet counts are being rebuilt by another process')
+
+@app.cli.command('refresh-labels')
+def refresh_labels_command():
+    with scheduler.background():
+        count = label_store.refresh_stale()
+    print(f'{count} labels refreshed')
+
+@app.cli.command('refresh-superclasses')
+def refresh_superclasses_command():
+    with scheduler.background():
+        wdqs.refresh_superclasses()
+
+@app.cli.command('set-item-columns')
+def set_item_columns_command():
+    ''' fill the columns copied from the entity for items saved before they existed '''
+    count = 0
+    last_id = 0
+    while True:
+        items = (Item.query.filter(Item.item_id > last_id)
+                           .order_by(Item.item_id)
+                           .limit(1000)
+                           .all())
+        if not items:
+            break
+        for item in items:
+            item.set_entity_columns(item.entity)
+        database.session.commit()
+        count += len(items)
+        last_id = items[-1].item_id
+    print(f'{count} items updated')
 
 def browse_index():
-    q = (database.session.query(Triple.predicate_id,
-                                func.count(func.distinct(Triple.object_id)))
-                         .join(Item, Triple.subject_id == Item.item_id)
-                         .filter_by(is_artwork=True)
-                         .group_by(Triple.predicate_id))
+    check_facet_counts()
+    q = (database.session.query(FacetCount.predicate_id, func.count())
+                         .group_by(FacetCount.predicate_id))
 
     counts = {f'P{predicate_id}': count for predicate_id, count in q}
 
@@ -840,7 +823,7 @@ def browse_facets():
     if not params:
         return jsonify(notice='facet criteria missing')
 
-    facets = get_facets(params)
+    facets = get_db_facets(params, facet_limit=15, props=find_more_props)
 
     for key, values in facets.items():
         for v in values:
@@ -852,17 +835,35 @@ def browse_facets():
 
 def get_db_items(params):
     ''' Get items for browse page based on criteria. '''
-    q = Item.query.filter_by(is_artwork=True)
+    q = Item.query.options(defer(Item.entity)).filter_by(is_artwork=True)
     for pid, qid in params:
         q = (q.join(Triple, Item.item_id == Triple.subject_id, aliased=True)
               .filter(Triple.predicate_id == pid[1:], Triple.object_id == qid[1:]))
 
     return q
 
-def get_db_facets(params):
+def get_db_facets(params, facet_limit=18, props=None):
+    ''' facet counts with labels, only for the predicates in props if given '''
+    if bitmap_index.enabled:
+        facet_list = bitmap_index.get_index().facets(params, facet_limit)
+    else:
+        facet_list = get_sql_facets(params, facet_limit)
+
+    if props is not None:
+        facet_list = {pid: values for pid, values in facet_list.items() if pid in props}
+
+    subject_qids = {v['qid'] for values in facet_list.values() for v in values}
+    labels = get_labels_db(subject_qids)
+
+    for values in facet_list.values():
+        for v in values:
+            v['label'] = labels.get(v['qid'])
+
+    return facet_list
+
+def get_sql_facets(params, facet_limit):
     t = aliased(Triple)
     q = database.session.query(t.predicate_id, func.count().label('count'), t.object_id)
-    facet_limit = 18
 
     for pid, qid in params:
         q = (q.join(Triple, t.subject_id == Triple.subject_id, aliased=True)
@@ -876,22 +877,80 @@ def get_db_facets(params):
     results = sorted(tuple(row) for row in q.all())
 
     facet_list = {}
-    subject_qids = set()
     for predicate_id, x in itertools.groupby(results, lambda row: row[0]):
         hits = sorted(list(x), key=lambda row: row[1], reverse=True)
-        values = [{'count': count, 'qid': f'Q{value}'}
-                  for _, count, value in hits[:facet_limit]]
-        facet_list[f'P{predicate_id}'] = values
-        subject_qids.update(i['qid'] for i in values)
-
-    labels = get_labels_db(subject_qids)
-
-    for values in facet_list.values():
-        for v in values:
-            v['label'] = labels.get(v['qid'])
-
+        facet_list[f'P{predicate_id}'] = [{'count': count, 'qid': f'Q{value}'}
+                                          for _, count, value in hits[:facet_limit]]
     return facet_list
 
+def browse_page_items(params, page, page_size):
+    ''' items with an image on a page of browse results, and the pager '''
+    if bitmap_index.enabled:
+        # only the items on this page are loaded
+        item_ids = bitmap_index.get_index().matching(params)
+        pager = Pagination(page, page_size, len(item_ids))
+        page_ids = pager.slice(item_ids)
+        q = Item.query.options(defer(Item.entity)).filter(Item.item_id.in_(page_ids))
+        found = {item.item_id: item for item in q}
+        page_items = [found[item_id] for item_id in page_ids if item_id in found]
+    else:
+        q_items = get_db_items(params)
+        all_items = q_items.all()
+        pager = Pagination(page, page_size, q_items.count())
+        page_items = pager.slice(all_items)
+
+    items = [item for item in page_items if item.image_filename()]
+    return items, pager
+
+def get_linked_qids(item_ids, props=('P31', 'P180')):
+    ''' {item_id: {pid: [qid]}} from the triple table, without loading entities '''
+    linked = {item_id: {pid: [] for pid in props} for item_id in item_ids}
+    if not item_ids:
+        return linked
+    q = (database.session.query(Triple.subject_id, Triple.predicate_id, Triple.object_id)
+                         .filter(Triple.subject_id.in_(item_ids),
+                                 Triple.predicate_id.in_([int(pid[1:]) for pid in props]))
+                         .order_by(Triple.object_id))
+    for subject_id, predicate_id, object_id in q:
+        linked[subject_id][f'P{predicate_id}'].append(f'Q{object_id}')
+    return linked
+
+def browse_linked_qids(params, items):
+    ''' QIDs the browse page needs labels for, sets item.linked for the template '''
+    linked = get_linked_qids([item.item_id for item in items])
+    linked_qids = {qid for pid, qid in params}
+    for item in items:
+        item.linked = linked[item.item_id]
+        artist_qid = item.artist
+        if artist_qid:
+            linked_qids.add(artist_qid)
+        for qids in item.linked.values():
+            linked_qids.update(qids)
+    return linked_qids
+
+def warm_browse_page(params, page, page_size, thumbwidth):
+    ''' load the image details and labels for a browse page into the caches '''
+    items, pager = browse_page_items(params, page, page_size)
+    commons.image_detail_with_cache([item.image_filename() for item in items],
+                                    thumbwidth=thumbwidth)
+    get_labels_db(browse_linked_qids(params, items))
+
+def prefetch_browse(params, pager, facets):
+    ''' warm the next page and the first page of the biggest facet links '''
+    args = (pager.per_page, app.config['THUMBWIDTH'])
+    if pager.has_next:
+        prefetch.submit(('browse', tuple(params), pager.page + 1),
+                        warm_browse_page, params, pager.page + 1, *args)
+
+    top = sorted(((v['count'], pid, v['qid'])
+                  for pid, values in facets.items() for v in values),
+                 reverse=True)
+    for count, pid, qid in top[:prefetch.facet_links]:
+        # same as set_url_args in the template, the link replaces a value for pid
+        link_params = [(p, q) for p, q in params if p != pid] + [(pid, qid)]
+        prefetch.submit(('browse', tuple(link_params), 1),
+                        warm_browse_page, link_params, 1, *args)
+
 @app.route('/browse')
 def browse_page():
     page_size = 45
@@ -900,42 +959,24 @@ def browse_page():
     if not params:
         return browse_index()
 
-    flat = '_'.join(f'{pid}={qid}' for pid, qid in params)
     item_labels = get_labels_db(qid for pid, qid in params)
     g.title = ' / '.join(find_more_props[pid] + ': ' + (item_labels.get(qid) or qid)
                          for pid, qid in params)
 
-    q_items = get_db_items(params)
     facets = get_db_facets(params)
 
-    all_items = q_items.all()
-
     page = utils.get_int_arg('page') or 1
-    total = q_items.count()
-    pager = Pagination(page, page_size, total)
-
-    items = [item for item in pager.slice(all_items) if item.image_filename()]
+    items, pager = browse_page_items(params, page, page_size)
+    total = pager.total_count
 
-    cache_name = f'{flat}_{page}_{page_size}'
-    detail = get_image_detail_with_cache(items, cache_name)
-    cache_refreshed = False
+    detail = commons.image_detail_with_cache([item.image_filename() for item in items],
+                                             thumbwidth=app.config['THUMBWIDTH'])
+    linked_labels = get_labels_db(browse_linked_qids(params, items))
 
-    linked_qids = {qid for pid, qid in params}
     for item in items:
-        artist_qid = item.artist
-        if artist_qid:
-            linked_qids.add(artist_qid)
-        for prop in 'P31', 'P180':
-            linked_qids.update(item.linked_qids(prop))
-
-    linked_labels = get_labels_db(linked_qids)
+        item.image = detail.get(item.image_filename())
 
-    for item in items:
-        image_filename = item.image_filename()
-        if not cache_refreshed and image_filename not in detail:
-            detail = get_image_detail_with_cache(items, cache_name, refresh=True)
-            cache_refreshed = True
-        item.image = detail.get(image_filename)
+    prefetch_browse(params, pager, facets)
 
     return render_template('find_more.html',
                            page=page,
@@ -978,11 +1019,12 @@ def find_more_json():
                       'href': url_for('item_page', item_id=item_id),
                       'filename': image_filename})
 
-    thumbheight = 120
-    detail = commons.image_detail(filenames, thumbheight=thumbheight)
+    # a thumbnail by height needs an API call, the page sets the height instead
+    thumbwidth = 250
+    detail = commons.image_detail_with_cache(filenames, thumbwidth=thumbwidth)
 
     for item in items:
-        item['image'] = detail[item['filename']]
+        item['image'] = detail.get(item['filename'])
 
     return jsonify(items=items)
 
@@ -1029,7 +1071,7 @@ def add_images_to_depicts_lookup(hits):
                  if hit.get('image_filename')]
     filenames = filenames[:50]
     thumbwidth = 200
-    detail = commons.image_detail(filenames, thumbwidth=thumbwidth)
+    detail = commons.image_detail_with_cache(filenames, thumbwidth=thumbwidth)
 
     for hit in hits:
         filename = hit.get('image_filename')
@@ -1121,10 +1163,51 @@ def missing_image_report():
 
     return render_template('missing_image.html', item_list=item_list)
 
+def wikidata_query_stats(since):
+    ''' per template query count, duration percentiles, error rate and mean row count '''
+    duration = func.extract('epoch', WikidataQuery.end_time - WikidataQuery.start_time)
+    is_error = case([(WikidataQuery.status_code != 200, 1.0)], else_=0.0)
+
+    q = (database.session.query(WikidataQuery.query_template,
+                                func.count().label('count'),
+                                func.percentile_cont(0.5).within_group(duration).label('p50'),
+                                func.percentile_cont(0.95).within_group(duration).label('p95'),
+                                func.percentile_cont(0.99).within_group(duration).label('p99'),
+                                func.avg(is_error).label('error_rate'),
+                                func.avg(WikidataQuery.row_count).label('mean_rows'))
+                         .group_by(WikidataQuery.query_template)
+                         .order_by(desc('p95')))
+    if since:
+        q = q.filter(WikidataQuery.start_time >= since)
+
+    return q
+
 @app.route('/report/wdqs')
 def wikidata_query_list():
-    q = WikidataQuery.query.order_by(WikidataQuery.start_time.desc())
-    return render_template('query_list.html', q=q)
+    hours = utils.get_int_arg('hours')
+    since = datetime.utcnow() - timedelta(hours=hours) if hours else None
+    template = request.args.get('template')
+    before = utils.get_int_arg('before')
+    page_size = 100
+
+    # keyset pagination on id, newer queries have higher ids
+    q = WikidataQuery.query.order_by(WikidataQuery.id.desc())
+    if since:
+        q = q.filter(WikidataQuery.start_time >= since)
+    if template:
+        q = q.filter(WikidataQuery.query_template == template)
+    if before:
+        q = q.filter(WikidataQuery.id < before)
+    query_list = q.limit(page_size).all()
+    next_before = query_list[-1].id if len(query_list) == page_size else None
+
+    return render_template('query_list.html',
+                           stats=wikidata_query_stats(since),
+                           short_template=WikidataQuery.short_template,
+                           hours=hours,
+                           template=template,
+                           next_before=next_before,
+                           q=query_list)
 
 @app.route('/report/blocks')
 def server_block_report():
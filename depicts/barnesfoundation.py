@@ -1,6 +1,7 @@
 import requests
 import os
 import json
+from . import utils, cache
 
 def get_json(catalog_id):
     filename = f'cache/barnesfoundation_{catalog_id}.html'
@@ -11,11 +12,11 @@ def get_json(catalog_id):
                                "must": {"match": {"_id": int(catalog_id)}}}}}
 
     if os.path.exists(filename):
-        return json.load(open(filename))
+        return cache.read_json(filename)
     else:
-        r = requests.get(url, params={'body': json.dumps(body)})
+        r = requests.get(utils.catalog_url(url), params={'body': json.dumps(body)})
         print(r.url)
-        open(filename, 'w').write(r.text)
+        cache.write_text(filename, r.text)
         return r.json()
 
 def parse_catalog(data):
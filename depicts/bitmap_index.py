@@ -0,0 +1,188 @@
+'''
+In-memory index of the triple table for browse filtering and facet counts.
+
+Each (predicate, object) pair maps to a bitmap of the artworks that have it,
+filtering is a bitmap intersection and a facet count is the size of an
+intersection. The index is loaded from the database on first use. Items
+written since then are read again every refresh_interval seconds and the
+whole index is reloaded every reload_interval seconds.
+'''
+
+import heapq
+import threading
+import time
+from datetime import timedelta
+from collections import defaultdict
+from .model import Item, Triple
+from . import database, utils
+
+try:
+    from pyroaring import BitMap
+    intersection_count = BitMap.intersection_cardinality
+except ImportError:  # plain sets work the same, with more memory
+    BitMap = set
+
+    def intersection_count(a, b):
+        return len(a & b)
+
+enabled = True
+refresh_interval = 5 * 60
+reload_interval = 24 * 3600
+refresh_overlap = timedelta(minutes=10)
+
+def init_app(app):
+    global enabled, refresh_interval, reload_interval
+    enabled = app.config.get('BITMAP_INDEX', enabled)
+    refresh_interval = app.config.get('BITMAP_INDEX_REFRESH', refresh_interval)
+    reload_interval = app.config.get('BITMAP_INDEX_RELOAD', reload_interval)
+
+def terms(params):
+    ''' browse params like [('P180', 'Q5')] as [(180, 5)] '''
+    return [(int(pid[1:]), int(qid[1:])) for pid, qid in params]
+
+def artwork_triples():
+    return (database.session.query(Triple.subject_id,
+                                   Triple.predicate_id,
+                                   Triple.object_id)
+                            .join(Item, Triple.subject_id == Item.item_id)
+                            .filter(Item.is_artwork))
+
+class BitmapIndex:
+    def __init__(self):
+        # postings and, for each predicate, its keys largest bitmap first.
+        # Replaced in one assignment, so readers need no lock.
+        self.snapshot = ({}, {})
+        self.updated = None
+        self.loaded = None
+        self.refreshed = None
+
+    def db_now(self):
+        return database.session.query(database.now_utc()).scalar()
+
+    def load(self):
+        updated = self.db_now()
+        postings = defaultdict(BitMap)
+        for subject_id, predicate_id, object_id in artwork_triples().yield_per(10000):
+            postings[(predicate_id, object_id)].add(subject_id)
+
+        self.snapshot = build_snapshot(dict(postings))
+        self.updated = updated
+        self.loaded = self.refreshed = time.time()
+
+    def update(self, item_ids):
+        ''' read the triples for these items again '''
+        rows = []
+        for cur in utils.chunk(item_ids, 1000):
+            rows += artwork_triples().filter(Triple.subject_id.in_(cur)).all()
+
+        # bitmaps that change are copied, readers keep the old ones
+        changed = BitMap(item_ids)
+        postings = dict(self.snapshot[0])
+        for key, bitmap in postings.items():
+            if intersection_count(bitmap, changed):
+                postings[key] = bitmap - changed
+        copied = set()
+        for subject_id, predicate_id, object_id in rows:
+            key = (predicate_id, object_id)
+            if key not in copied:
+                postings[key] = BitMap(postings.get(key, ()))
+                copied.add(key)
+            postings[key].add(subject_id)
+
+        postings = {key: bitmap for key, bitmap in postings.items() if bitmap}
+        self.snapshot = build_snapshot(postings)
+
+    def refresh(self):
+        ''' update the items written since the last refresh '''
+        updated = self.db_now()
+        q = database.session.query(Item.item_id)
+        if self.updated:
+            # a transaction that started before the last refresh can commit after it
+            q = q.filter(Item.updated > self.updated - refresh_overlap)
+        item_ids = [item_id for item_id, in q]
+        if item_ids:
+            self.update(item_ids)
+        self.updated = updated
+        self.refreshed = time.time()
+
+    def intersection(self, params, postings=None):
+        if postings is None:
+            postings = self.snapshot[0]
+        bitmaps = sorted((postings.get(key, BitMap()) for key in terms(params)),
+                         key=len)
+        if not bitmaps:
+            return BitMap()
+        result = BitMap(bitmaps[0])
+        for bitmap in bitmaps[1:]:
+            result &= bitmap
+        return result
+
+    def matching(self, params):
+        ''' IDs of artworks that match every param, in order '''
+        return sorted(self.intersection(params))
+
+    def facets(self, params, facet_limit):
+        '''
+        biggest facet_limit counts for each predicate within the artworks
+        that match params, in the same format as get_db_facets
+        '''
+        param_terms = terms(params)
+        skip_predicates = {predicate_id for predicate_id, _ in param_terms}
+        skip_objects = {object_id for _, object_id in param_terms}
+
+        postings, by_predicate = self.snapshot
+        matched = self.intersection(params, postings)
+        facet_list = {}
+        for predicate_id in sorted(by_predicate):
+            if predicate_id in skip_predicates:
+                continue
+            top = []
+            for key in by_predicate[predicate_id]:
+                bitmap = postings[key]
+                # the rest are smaller than the counts already found
+                if len(top) == facet_limit and len(bitmap) < top[0][0]:
+                    break
+                if key[1] in skip_objects:
+                    continue
+                count = intersection_count(matched, bitmap)
+                if not count:
+                    continue
+                if len(top) < facet_limit:
+                    heapq.heappush(top, (count, -key[1]))
+                elif (count, -key[1]) > top[0]:
+                    heapq.heapreplace(top, (count, -key[1]))
+            if top:
+                facet_list[f'P{predicate_id}'] = [
+                    {'count': count, 'qid': f'Q{-neg_object_id}'}
+                    for count, neg_object_id in sorted(top, reverse=True)]
+
+        return facet_list
+
+def build_snapshot(postings):
+    by_predicate = defaultdict(list)
+    for key in postings:
+        by_predicate[key[0]].append(key)
+    for keys in by_predicate.values():
+        keys.sort(key=lambda key: len(postings[key]), reverse=True)
+    return postings, dict(by_predicate)
+
+index = BitmapIndex()
+refresh_lock = threading.Lock()
+
+def get_index():
+    ''' the index, loaded or brought up to date first when needed '''
+    now = time.time()
+    if index.loaded is None:
+        with refresh_lock:
+            if index.loaded is None:
+                index.load()
+    elif now - index.refreshed > refresh_interval and refresh_lock.acquire(blocking=False):
+        # other requests keep using the index while one of them refreshes it
+        try:
+            if now - index.loaded > reload_interval:
+                index.load()
+            else:
+                index.refresh()
+        finally:
+            refresh_lock.release()
+    return index
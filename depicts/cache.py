@@ -0,0 +1,355 @@
+import os
+import json
+import hashlib
+import gzip
+import time
+import fcntl
+import argparse
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+gzip_magic = b'\x1f\x8b'
+zstd_magic = b'\x28\xb5\x2f\xfd'
+
+read_errors = (ValueError, OSError, EOFError)
+if zstandard:
+    read_errors += (zstandard.ZstdError,)
+
+def dumps(value):
+    if orjson:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+def loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def open_write(filename, mode='wb'):
+    ''' open a file that compresses what is written, zstd if available, otherwise gzip '''
+    encoding = 'utf-8' if 't' in mode else None
+    if zstandard:
+        cctx = zstandard.ZstdCompressor(level=3)
+        return zstandard.open(filename, mode, cctx=cctx, encoding=encoding)
+    return gzip.open(filename, mode, compresslevel=5, encoding=encoding)
+
+def open_read(filename, mode='rb'):
+    ''' open a cache file, compressed or not '''
+    encoding = 'utf-8' if 't' in mode else None
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(gzip_magic):
+        return gzip.open(filename, mode, encoding=encoding)
+    if magic == zstd_magic:
+        return zstandard.open(filename, mode, encoding=encoding)
+    return open(filename, mode.replace('t', ''), encoding=encoding)
+
+def is_compressed(filename):
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+    return magic.startswith(gzip_magic) or magic == zstd_magic
+
+def tmp_filename(filename):
+    return f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+def write_bytes(filename, data):
+    tmp = tmp_filename(filename)
+    with open_write(tmp) as f:
+        f.write(data)
+    os.replace(tmp, filename)
+
+def read_bytes(filename):
+    with open_read(filename) as f:
+        return f.read()
+
+def write_text(filename, text):
+    write_bytes(filename, text.encode('utf-8'))
+
+def read_text(filename):
+    return read_bytes(filename).decode('utf-8')
+
+def write_json(filename, value):
+    write_bytes(filename, dumps(value))
+
+def read_json(filename):
+    return loads(read_bytes(filename))
+
+class MemoryCache:
+    '''
+    in-process LRU cache holding at most max_bytes of values
+
+    The size of a value is the length of its JSON. Values bigger than
+    max_item_bytes are not kept, they are read from the disk cache instead.
+    '''
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_item_bytes=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def set(self, key, value):
+        size = len(dumps(value))
+        with self.lock:
+            self.remove(key)
+            if size > self.max_item_bytes:
+                return
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def remove(self, key):
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[1]
+
+    def delete(self, key):
+        with self.lock:
+            self.remove(key)
+
+class DiskCache:
+    '''
+    one JSON file per key, total size capped at max_bytes
+
+    Files are compressed, see open_write. Values with a long list of rows
+    can be stored as JSON lines: a header
+    line followed by one line per row, so they can be written and read back
+    without holding every row in memory.
+
+    The file modification time is bumped on every hit, so eviction removes the
+    least recently used files first.
+    '''
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = None
+        self.lock = threading.Lock()
+
+    def filename(self, key, ext='json'):
+        return os.path.join(self.directory, f'{key}.{ext}')
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            value = read_json(filename)
+            os.utime(filename)
+        except read_errors:
+            return
+        return value
+
+    def set(self, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self.filename(key)
+        write_json(filename, value)
+        self.added(os.path.getsize(filename))
+
+    def get_many(self, keys):
+        ''' {key: value} for the keys found '''
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def delete(self, key):
+        for ext in 'json', 'jsonl':
+            try:
+                os.remove(self.filename(key, ext))
+            except FileNotFoundError:
+                pass
+
+    def get_rows(self, key):
+        ''' return the header and an iterator over the rows, or None on a miss '''
+        filename = self.filename(key, 'jsonl')
+        try:
+            f = open_read(filename, 'rt')
+        except FileNotFoundError:
+            return
+        try:
+            header = loads(f.readline())
+        except read_errors:
+            f.close()
+            return
+        os.utime(filename)
+
+        def rows():
+            with f:
+                for line in f:
+                    yield loads(line)
+
+        return header, rows()
+
+    def set_rows(self, key, header, rows):
+        '''
+        write header and rows, yielding each row once it has been written
+
+        The file only replaces the existing entry when every row has been
+        consumed, a partial result is discarded.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self.filename(key, 'jsonl')
+        tmp = tmp_filename(filename)
+        complete = False
+        try:
+            with open_write(tmp) as f:
+                f.write(dumps(header) + b'\n')
+                for row in rows:
+                    f.write(dumps(row) + b'\n')
+                    yield row
+            os.replace(tmp, filename)
+            complete = True
+        finally:
+            if not complete:
+                os.remove(tmp)
+        self.added(os.path.getsize(filename))
+
+    def scan(self):
+        files = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file() or not entry.name.endswith(('.json', '.jsonl')):
+                    continue
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.path))
+        return files
+
+    def added(self, size):
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self.scan())
+            else:
+                self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        ''' remove least recently used files until the cache is at 90% of max_bytes '''
+        files = sorted(self.scan())
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * 0.9
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total_bytes = total
+
+class StoreSet:
+    ''' a DiskCache in a subdirectory for each name, created on first use '''
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stores = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.stores:
+                self.stores[name] = DiskCache(os.path.join(self.directory, name),
+                                              max_bytes=self.max_bytes)
+            return self.stores[name]
+
+class KeyLock:
+    '''
+    only let one caller at a time work on a key
+
+    Threads in this process queue on a lock per key, the thread holding it
+    then takes an exclusive flock on a lock file so other worker processes
+    wait too. Keys are hashed into a fixed number of lock files, so the
+    directory doesn't grow; two keys sharing a file only wait for each other.
+    '''
+
+    def __init__(self, directory, lock_files=64):
+        self.directory = directory
+        self.lock_files = lock_files
+        self.locks = {}
+        self.guard = threading.Lock()
+
+    def lock_filename(self, key):
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        slot = int.from_bytes(digest[:4], 'big') % self.lock_files
+        return os.path.join(self.directory, f'{slot}.lock')
+
+    @contextmanager
+    def __call__(self, key):
+        with self.guard:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(self.lock_filename(key), 'a') as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+        finally:
+            with self.guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
+
+def is_fresh(entry, ttl):
+    if ttl is None:
+        return True
+    return time.time() - entry.get('timestamp', 0) < ttl
+
+def migrate(directory):
+    ''' compress every uncompressed file under directory, keeping modification times '''
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in filenames:
+            if name.endswith(('.lock', '.tmp')):
+                continue
+            filename = os.path.join(dirpath, name)
+            if is_compressed(filename):
+                continue
+            st = os.stat(filename)
+            with open(filename, 'rb') as f:
+                data = f.read()
+            if name.endswith('.json'):
+                try:
+                    data = dumps(loads(data))  # drop the indent
+                except ValueError:
+                    pass
+            write_bytes(filename, data)
+            os.utime(filename, (st.st_atime, st.st_mtime))
+            count += 1
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description='compress files in the cache directory')
+    parser.add_argument('directory', nargs='?', default='cache')
+    args = parser.parse_args()
+    print(f'{migrate(args.directory)} files compressed')
+
+if __name__ == '__main__':
+    main()
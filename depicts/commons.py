@@ -1,9 +1,79 @@
-from . import mediawiki, utils
+from . import mediawiki, utils, image_cache
+import requests.exceptions
+import urllib.parse
+import hashlib
+import bisect
 
 commons_url = 'https://commons.wikimedia.org/w/api.php'
+upload_url = 'https://upload.wikimedia.org/wikipedia/commons'
 page_size = 50
 
+# thumbnail widths Commons has ready, locally built URLs round up to one of these
+thumb_widths = [120, 250, 330, 500, 960, 1280, 1920]
+
+# other formats get thumbnails with a different file type or a page number,
+# those URLs come from the API
+local_thumb_extensions = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
+
+# the parts of imageinfo that don't depend on the thumbnail size
+original_keys = ('url', 'descriptionurl', 'width', 'height')
+
+def init_app(app):
+    global commons_url, upload_url
+    commons_url = app.config.get('COMMONS_API_URL', commons_url)
+    upload_url = app.config.get('COMMONS_UPLOAD_URL', upload_url)
+
+def thumb_width(width):
+    ''' the narrowest of thumb_widths that is at least width, or None '''
+    i = bisect.bisect_left(thumb_widths, width)
+    if i < len(thumb_widths):
+        return thumb_widths[i]
+
+def has_local_thumb(filename):
+    return filename.rpartition('.')[2].lower() in local_thumb_extensions
+
+def original_detail(detail):
+    return {key: detail[key] for key in original_keys if key in detail}
+
+def local_image_detail(filename, thumbwidth, original):
+    '''
+    the imageinfo the API would return, built from the details of the original
+    image and the md5 of the filename
+    '''
+    # Commons doesn't scale images up, it gives an error instead
+    if thumbwidth >= original['width']:
+        return {**original, 'thumburl': original['url']}
+
+    name = filename.replace(' ', '_')
+    md5 = hashlib.md5(name.encode('utf-8')).hexdigest()
+    path = f'{md5[0]}/{md5[:2]}/' + urllib.parse.quote(name)
+
+    # MediaWiki shortens the thumbnail name for long filenames
+    if len(name.encode('utf-8')) > 160:
+        thumb_name = 'thumbnail.' + name.rpartition('.')[2].lower()
+    else:
+        thumb_name = name
+
+    return {
+        **original,
+        'thumburl': f'{upload_url}/thumb/{path}/{thumbwidth}px-' + urllib.parse.quote(thumb_name),
+        'thumbwidth': thumbwidth,
+        'thumbheight': round(original['height'] * thumbwidth / original['width']),
+    }
+
+def split_local(filenames, thumbwidth):
+    '''
+    details that can be built locally, and the filenames that need the API
+
+    The width of the original has to be known, from an earlier API call.
+    '''
+    originals = image_cache.get_many([f for f in filenames if has_local_thumb(f)])
+    images = {f: local_image_detail(f, thumbwidth, original)
+              for f, original in originals.items() if original.get('width')}
+    return images, [f for f in filenames if f not in images]
+
 def image_detail(filenames, thumbheight=None, thumbwidth=None):
+    ''' image URLs and the size of the original for filenames '''
     if not isinstance(filenames, list):
         filenames = [filenames]
     if not filenames:
@@ -12,7 +82,7 @@ def image_detail(filenames, thumbheight=None, thumbwidth=None):
     params = {
         'action': 'query',
         'prop': 'imageinfo',
-        'iiprop': 'url',
+        'iiprop': 'url|size',
     }
     if thumbheight is not None:
         params['iiurlheight'] = thumbheight
@@ -20,7 +90,6 @@ def image_detail(filenames, thumbheight=None, thumbwidth=None):
         params['iiurlwidth'] = thumbwidth
 
     images = {}
-
     for cur in utils.chunk(filenames, page_size):
         call_params = params.copy()
         call_params['titles'] = '|'.join(f'File:{f}' for f in cur)
@@ -33,4 +102,33 @@ def image_detail(filenames, thumbheight=None, thumbwidth=None):
 
     return images
 
+def image_detail_with_cache(filenames, thumbheight=None, thumbwidth=None):
+    '''
+    image_detail with each image stored by filename and thumbnail size, only
+    images missing from the store are requested from Commons
 
+    Once the size of the original is stored the thumbnail URL is built
+    locally, with the width rounded up to one of thumb_widths. The API is
+    asked for the exact width.
+    '''
+    size = {'thumbheight': thumbheight, 'thumbwidth': thumbwidth}
+
+    filenames = list(dict.fromkeys(filenames))
+    images = {}
+    local_width = thumb_width(thumbwidth) if thumbwidth is not None else None
+    if thumbheight is None and local_width:
+        images, filenames = split_local(filenames, local_width)
+    images.update(image_cache.get_many(filenames, **size))
+    missing = [f for f in filenames if f not in images]
+
+    try:
+        fetched = image_detail(missing, **size)
+    except requests.exceptions.ReadTimeout:
+        fetched = {}  # the rest are fetched next time
+    for filename, detail in fetched.items():
+        if detail:
+            image_cache.put(filename, detail, **size)
+            image_cache.put(filename, original_detail(detail))
+        images[filename] = detail
+
+    return images
@@ -0,0 +1,53 @@
+import time
+from . import cache
+
+cache_dir = 'cache/entity'
+stores = cache.StoreSet(cache_dir)
+
+# entities older than this are fetched again
+ttl = 24 * 3600
+
+def init_app(app):
+    global stores, ttl
+    stores = cache.StoreSet(cache_dir, max_bytes=app.config.get('ENTITY_CACHE_MAX_BYTES'))
+    ttl = app.config.get('ENTITY_CACHE_TTL', ttl)
+
+def params_key(params):
+    ''' directory name for entities fetched with these wbgetentities params '''
+    if not params:
+        return 'all'
+    return '_'.join(f'{k}={v}'.replace('|', '+') for k, v in sorted(params.items()))
+
+def get_store(params):
+    return stores[params_key(params)]
+
+def read(store, qid, check_age):
+    entry = store.get(qid)
+    if entry is None or 'entity' not in entry:  # entries without a timestamp are old
+        return
+    if check_age and not cache.is_fresh(entry, ttl):
+        return
+    return entry['entity']
+
+def get(qid, check_age=True, **params):
+    '''
+    cached entity, or None if it is missing or older than ttl
+
+    Callers that compare lastrevid themselves pass check_age=False.
+    '''
+    entity = read(get_store(params), qid, check_age)
+    if entity is None and set(params) == {'props'}:
+        # a full entity has every prop
+        entity = read(get_store({}), qid, check_age)
+    return entity
+
+def put(qid, entity, **params):
+    get_store(params).set(qid, {'entity': entity, 'timestamp': time.time()})
+
+def get_many(ids, **params):
+    found = {}
+    for qid in ids:
+        entity = get(qid, **params)
+        if entity is not None:
+            found[qid] = entity
+    return found
@@ -0,0 +1,24 @@
+'''
+Run independent blocking calls at the same time, for views that fan out to
+several upstream APIs.
+'''
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from . import database
+
+def call(func, *args):
+    ''' run in a worker thread, with its own database session '''
+    try:
+        return func(*args)
+    finally:
+        database.session.remove()
+
+def run(*calls):
+    ''' run each (func, *args) in its own thread, return the results in order '''
+    # a pool for each call, so one request never waits behind another's calls
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        # workers keep the caller's request priority, see scheduler.background
+        futures = [executor.submit(contextvars.copy_context().run, call, *c)
+                   for c in calls]
+        return [future.result() for future in futures]
@@ -0,0 +1,46 @@
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from . import scheduler
+
+user_agent = 'WADE/0.1 (https://art.wikidata.link/; https://github.com/edwardbetts/depicts)'
+
+# connections kept open to each host
+pool_maxsize = 10
+
+def build_session():
+    '''
+    session with keep-alive connection pools and backoff retries
+
+    429 and 503 replies are left to the scheduler, it slows down every
+    request to the host, not only the one that was throttled.
+    '''
+    retry = Retry(total=3,
+                  backoff_factor=0.5,
+                  status_forcelist=(500, 502, 504),
+                  allowed_methods=None,  # API reads use POST too, retry them
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=10,
+                          pool_maxsize=pool_maxsize,
+                          pool_block=True,
+                          max_retries=retry)
+
+    s = requests.Session()
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    s.headers['User-Agent'] = user_agent
+    return s
+
+session = build_session()
+
+def init_app(app):
+    global user_agent, pool_maxsize, session
+    user_agent = app.config.get('USER_AGENT', user_agent)
+    pool_maxsize = app.config.get('HTTP_POOL_MAXSIZE', pool_maxsize)
+    session = build_session()
+
+def get(url, **kwargs):
+    return scheduler.request(session.get, url, user_agent, **kwargs)
+
+def post(url, **kwargs):
+    return scheduler.request(session.post, url, user_agent, **kwargs)
@@ -0,0 +1,28 @@
+import hashlib
+from . import cache
+
+cache_dir = 'cache/image'
+stores = cache.StoreSet(cache_dir)
+
+def init_app(app):
+    global stores
+    stores = cache.StoreSet(cache_dir, max_bytes=app.config.get('IMAGE_CACHE_MAX_BYTES'))
+
+def size_key(thumbheight=None, thumbwidth=None):
+    ''' directory name for image details with this thumbnail size '''
+    if thumbheight is not None:
+        return f'height={thumbheight}'
+    if thumbwidth is not None:
+        return f'width={thumbwidth}'
+    return 'original'
+
+def file_key(filename):
+    return hashlib.md5(filename.encode('utf-8')).hexdigest()
+
+def put(filename, detail, **size):
+    stores[size_key(**size)].set(file_key(filename), detail)
+
+def get_many(filenames, **size):
+    keys = {file_key(filename): filename for filename in filenames}
+    found = stores[size_key(**size)].get_many(keys)
+    return {keys[key]: detail for key, detail in found.items()}
@@ -0,0 +1,137 @@
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from datetime import datetime, timedelta
+from .model import Label, Item
+from . import mediawiki, wikibase, database, utils
+import requests.exceptions
+import re
+
+re_qid = re.compile(r'^Q(\d+)$')
+
+# order of preference when an item has labels in several languages
+preferred_languages = ['en', 'mul']
+
+def entity_labels(entity):
+    '''
+    labels to store as {lang: label}, a single value is picked the same way as
+    wikibase.get_entity_label for items without an en or mul label
+    '''
+    all_labels = entity.get('labels', {})
+    labels = {lang: all_labels[lang]['value']
+              for lang in preferred_languages if lang in all_labels}
+    if labels:
+        return labels
+
+    label = wikibase.get_entity_label(entity)
+    if not label:
+        return {'en': None}
+    lang = next(lang for lang, l in all_labels.items() if l['value'] == label)
+    return {lang: label}
+
+def fetch_labels(qids):
+    '''
+    fetch labels from Wikidata, only English and multiple languages (mul)
+    labels are requested
+
+    Items with neither get a second request for all their labels.
+    '''
+    entities = mediawiki.get_entities_dict(qids,
+                                           props='labels',
+                                           languages='|'.join(preferred_languages))
+    labels = {}
+    no_label = []
+    for key, entity in entities.items():
+        # a redirected entity is returned under the ID it redirects to
+        qid = entity.get('redirects', {}).get('from', key)
+        if entity.get('labels') or 'missing' in entity:
+            labels[qid] = entity_labels(entity)
+        else:
+            no_label.append(qid)
+
+    for key, entity in mediawiki.get_entities_dict(no_label, props='labels').items():
+        qid = entity.get('redirects', {}).get('from', key)
+        labels[qid] = entity_labels(entity)
+
+    return labels
+
+def save_labels(labels):
+    ''' bulk upsert {qid: {lang: label}} '''
+    now = datetime.utcnow()
+    values = [{'item_id': int(qid[1:]), 'lang': lang, 'label': label, 'updated': now}
+              for qid, item_labels in labels.items()
+              for lang, label in item_labels.items()]
+    if not values:
+        return
+    stmt = insert(Label.__table__).values(values)
+    stmt = stmt.on_conflict_do_update(index_elements=['item_id', 'lang'],
+                                      set_={'label': stmt.excluded.label,
+                                            'updated': stmt.excluded.updated})
+    database.session.execute(stmt)
+    database.session.commit()
+
+def pick_label(item_labels):
+    for lang in preferred_languages:
+        if item_labels.get(lang):
+            return item_labels[lang]
+    return next((label for label in item_labels.values() if label), None)
+
+def lookup(item_ids):
+    ''' {qid: {lang: label}} for items in the label table, in one query '''
+    found = {}
+    if not item_ids:
+        return found
+    for row in Label.query.filter(Label.item_id.in_(item_ids)):
+        found.setdefault(f'Q{row.item_id}', {})[row.lang] = row.label
+    return found
+
+def get_labels(qids):
+    '''
+    label for each QID
+
+    Labels come from the label table, then from entities in the item table,
+    anything still missing is fetched from Wikidata. New labels are saved.
+    '''
+    item_ids = {int(m.group(1)) for m in map(re_qid.match, qids) if m}
+    found = lookup(item_ids)
+
+    missing = {item_id for item_id in item_ids if f'Q{item_id}' not in found}
+    new_labels = {}
+    if missing:
+        q = (database.session.query(Item.item_id, Item.en_label)
+                             .filter(Item.item_id.in_(missing), Item.en_label.isnot(None)))
+        for item_id, en_label in q:
+            new_labels[f'Q{item_id}'] = {'en': en_label}
+        # only items without an English label need the entity
+        no_en = [item_id for item_id in missing if f'Q{item_id}' not in new_labels]
+        for item in Item.query.filter(Item.item_id.in_(no_en)):
+            new_labels[item.qid] = entity_labels(item.entity)
+        missing = [f'Q{item_id}' for item_id in missing
+                   if f'Q{item_id}' not in new_labels]
+        try:
+            new_labels.update(fetch_labels(missing))
+        except requests.exceptions.ReadTimeout:
+            pass
+        save_labels(new_labels)
+        found.update(new_labels)
+
+    return {qid: pick_label(item_labels) for qid, item_labels in found.items()}
+
+def refresh_stale(max_age=timedelta(days=30), limit=5000):
+    ''' fetch labels again for the items updated longest ago '''
+    cutoff = datetime.utcnow() - max_age
+    q = (database.session.query(Label.item_id)
+                         .filter(Label.updated < cutoff)
+                         .group_by(Label.item_id)
+                         .order_by(func.min(Label.updated))
+                         .limit(limit))
+    qids = [f'Q{item_id}' for item_id, in q]
+
+    for cur in utils.chunk(qids, 500):
+        labels = fetch_labels(list(cur))
+        # languages that no longer have a label are removed
+        item_ids = [int(qid[1:]) for qid in labels]
+        (Label.query.filter(Label.item_id.in_(item_ids))
+                    .delete(synchronize_session=False))
+        save_labels(labels)
+
+    return len(qids)
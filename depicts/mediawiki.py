@@ -1,37 +1,53 @@
-import requests
-import os
-import json
-import hashlib
+import requests.exceptions
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from .category import Category
-from . import utils
+from . import utils, http_client, entity_cache, scheduler
 
 wikidata_url = 'https://www.wikidata.org/w/api.php'
 page_size = 50
 
+# chunks of entities fetched at the same time
+max_workers = 8
+executor = ThreadPoolExecutor(max_workers=max_workers)
+
 hosts = {
     'commons': 'commons.wikimedia.org',
     'enwiki': 'en.wikipedia.org',
     'wikidata': 'www.wikidata.org',
 }
 
-def api_call(params, api_url=wikidata_url):
+api_urls = {site: f'https://{host}/w/api.php' for site, host in hosts.items()}
+
+def init_app(app):
+    global wikidata_url, max_workers, executor
+    max_workers = app.config.get('ENTITY_FETCH_WORKERS', max_workers)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    wikidata_url = app.config.get('WIKIDATA_API_URL', wikidata_url)
+    api_urls['wikidata'] = wikidata_url
+    if app.config.get('COMMONS_API_URL'):
+        api_urls['commons'] = app.config['COMMONS_API_URL']
+
+def api_call(params, api_url=None):
     call_params = {
         'format': 'json',
         'formatversion': 2,
+        **scheduler.maxlag_params(),
         **params,
     }
 
-    r = requests.get(api_url, params=call_params, timeout=5)
+    r = http_client.get(api_url or wikidata_url, params=call_params, timeout=5)
     return r
 
-def api_post(params, api_url=wikidata_url):
+def api_post(params, api_url=None):
     call_params = {
         'format': 'json',
         'formatversion': 2,
+        **scheduler.maxlag_params(),
         **params,
     }
 
-    r = requests.post(api_url, data=call_params, timeout=5)
+    r = http_client.post(api_url or wikidata_url, data=call_params, timeout=5)
     return r
 
 def get_list(list_name, **params):
@@ -60,74 +76,98 @@ def wbgetentities(ids, **params):
     }
     return api_call(params).json()['entities']
 
+def wbgetentities_chunks(ids, **params):
+    '''
+    fetch ids in chunks of page_size, several chunks at a time
+
+    Results are returned in chunk order. A chunk that fails is left out,
+    the error is only raised if every chunk failed.
+    '''
+    chunks = list(utils.chunk(ids, page_size))
+    if len(chunks) == 1:
+        return [wbgetentities(chunks[0], **params)]
+
+    # worker threads keep the caller's request priority
+    futures = [executor.submit(contextvars.copy_context().run, wbgetentities, cur, **params)
+               for cur in chunks]
+    results = []
+    error = None
+    for future in futures:
+        try:
+            results.append(future.result())
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            print(f'wbgetentities failed: {e!r}')
+            error = e
+    if error and not results:
+        raise error
+    return results
+
 def get_entities(ids, **params):
     entity_list = []
-    for cur in utils.chunk(ids, page_size):
-        entity_list += wbgetentities(cur, **params).values()
+    for entities in wbgetentities_chunks(ids, **params):
+        entity_list += entities.values()
     return entity_list
 
 def get_entities_dict(ids, **params):
     entities = {}
-    for cur in utils.chunk(ids, page_size):
-        entities.update(wbgetentities(cur, **params))
+    for cur in wbgetentities_chunks(ids, **params):
+        entities.update(cur)
     return entities
 
 def get_entity_with_cache(qid, refresh=False):
-    filename = f'cache/{qid}.json'
-    if not refresh and os.path.exists(filename):
-        entity = json.load(open(filename))
-    else:
+    entity = None if refresh else entity_cache.get(qid)
+    if entity is None:
         entity = get_entity(qid, redirects=True)
-        json.dump(entity, open(filename, 'w'), indent=2)
+        if entity:
+            entity_cache.put(qid, entity)
 
     return entity
 
-def get_entities_with_cache(ids, **params):
-    md5 = hashlib.md5(' '.join(ids).encode('utf-8')).hexdigest()
+def get_lastrevids(ids):
+    ''' current revision ID of each entity, using the small props=info reply '''
+    lastrevids = {}
+    for key, entity in get_entities_dict(ids, props='info').items():
+        if 'lastrevid' in entity:
+            qid = entity.get('redirects', {}).get('from', key)
+            lastrevids[qid] = entity['lastrevid']
+    return lastrevids
 
-    filename = f'cache/entities_{md5}.json'
-    if os.path.exists(filename):
-        entity_list = json.load(open(filename))
-    else:
-        entity_list = get_entities(ids, **params)
-        json.dump(entity_list, open(filename, 'w'), indent=2)
+def get_current_entity(qid, stored=None):
+    '''
+    Return the entity for qid, only downloading it if the revision on
+    Wikidata differs from the cached copy.
 
-    return entity_list
+    stored is another copy of the entity to check, from the item table.
+    '''
+    lastrevid = get_lastrevids([qid]).get(qid)
+    for entity in entity_cache.get(qid, check_age=False), stored:
+        if entity and lastrevid and entity.get('lastrevid') == lastrevid:
+            # still the current revision, so the cached copy is fresh again
+            entity_cache.put(qid, entity)
+            return entity
 
-def get_entities_dict_with_cache(all_ids, **params):
-    entities = {}
-    for ids in utils.chunk(all_ids, page_size):
-        md5 = hashlib.md5(' '.join(ids).encode('utf-8')).hexdigest()
+    return get_entity_with_cache(qid, refresh=True)
 
-        filename = f'cache/entities_dict_{md5}.json'
-        if os.path.exists(filename):
-            entities.update(json.load(open(filename)))
-            continue
-        cur = wbgetentities(ids, **params)
-        json.dump(cur, open(filename, 'w'), indent=2)
-        entities.update(cur)
-    return entities
+def get_entities_with_cache(ids, **params):
+    entities = get_entities_dict_with_cache(ids, **params)
+    return [entities[qid] for qid in dict.fromkeys(ids) if qid in entities]
 
-def mediawiki_query(titles, params, site):
-    if not titles:
-        return []
+def get_entities_dict_with_cache(all_ids, **params):
+    ''' entities from the per-entity cache, only missing IDs are fetched '''
+    all_ids = list(dict.fromkeys(all_ids))
+    entities = entity_cache.get_many(all_ids, **params)
+    missing = [qid for qid in all_ids if qid not in entities]
 
-    # avoid error: Too many values supplied for parameter "titles". The limit is 50.
-    # FIXME: switch to utils.chunk
-    if len(titles) > page_size:
-        titles = titles[:page_size]
-    base = {
-        'format': 'json',
-        'formatversion': 2,
-        'action': 'query',
-        'continue': '',
-        'titles': '|'.join(titles),
-    }
-    p = base.copy()
-    p.update(params)
+    for key, entity in get_entities_dict(missing, **params).items():
+        # a redirected entity is returned under the ID it redirects to
+        qid = entity.get('redirects', {}).get('from', key)
+        entity_cache.put(qid, entity, **params)
+        entities[qid] = entity
+
+    return entities
 
-    query_url = f'https://{hosts[site]}/w/api.php'
-    r = requests.get(query_url, params=p)
+def mediawiki_request(query_url, params):
+    r = http_client.get(query_url, params=params)
     expect = 'application/json; charset=utf-8'
     success = True
     if r.status_code != 200:
@@ -141,7 +181,50 @@ def mediawiki_query(titles, params, site):
     if 'query' not in json_reply:
         print(r.url)
         print(r.text)
-    return json_reply['query']['pages']
+    return json_reply
+
+def iter_mediawiki_query(titles, params, site):
+    '''
+    yield pages as they arrive, titles are sent in chunks of page_size and
+    continuation is followed
+
+    With continuation the same page can be yielded more than once, each
+    time with the next batch of revisions or categories.
+    '''
+    base = {
+        'format': 'json',
+        'formatversion': 2,
+        **scheduler.maxlag_params(),
+        'action': 'query',
+        'continue': '',
+    }
+    query_url = api_urls[site]
+
+    for cur in utils.chunk(titles, page_size):
+        p = {**base, 'titles': '|'.join(cur), **params}
+        while True:
+            json_reply = mediawiki_request(query_url, p)
+            yield from json_reply.get('query', {}).get('pages', [])
+            if 'continue' not in json_reply:
+                break
+            p = {**p, **json_reply['continue']}
+
+def mediawiki_query(titles, params, site):
+    ''' list of pages, partial pages from continuation are merged '''
+    pages = {}
+    for page in iter_mediawiki_query(titles, params, site):
+        title = page['title']
+        if title not in pages:
+            pages[title] = page
+            continue
+        existing = pages[title]
+        for key, value in page.items():
+            if isinstance(value, list):
+                existing.setdefault(key, []).extend(value)
+            else:
+                existing.setdefault(key, value)
+
+    return list(pages.values())
 
 def get_content_and_categories(title, site):
     params = {
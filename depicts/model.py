@@ -1,9 +1,9 @@
 from sqlalchemy.ext.declarative import declarative_base
 from .database import session, now_utc
 from . import wikibase, utils
-from sqlalchemy.schema import Column, ForeignKey
+from sqlalchemy.schema import Column, ForeignKey, Index
 from sqlalchemy.types import Integer, String, DateTime, Boolean
-from sqlalchemy.orm import column_property, relationship, synonym
+from sqlalchemy.orm import column_property, relationship, synonym, validates
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.sql.expression import cast
 from sqlalchemy.dialects import postgresql
@@ -48,36 +48,68 @@ class Item(Base):
     __tablename__ = 'item'
     item_id = Column(Integer, primary_key=True, autoincrement=False)
     # label = Column(String)  # column removed 2019-12-18
-    entity = Column(postgresql.JSON)
+    entity = Column(postgresql.JSONB)
     lastrevid = Column(Integer, nullable=True, unique=True)
     modified = Column(DateTime, nullable=True)
+    # when this row was last written, modified is the time of the Wikidata edit
+    updated = Column(DateTime, default=now_utc(), onupdate=now_utc(), index=True)
     is_artwork = Column(Boolean, nullable=False, default=False)
     qid = column_property('Q' + cast(item_id, String))
 
+    # copied from the entity when it is set, so listing pages can skip it
+    image_file = Column(String)
+    has_depicts = Column(Boolean, index=True)
+    artist_id = Column(Integer, index=True)
+    en_label = Column(String)
+    entity_label = Column(String)  # en_label, or the label used in every language
+    inception_year = Column(Integer, index=True)
+    inception_date = Column(String)  # formatted with the precision of the value
+
+    __table_args__ = (
+        Index('ix_item_entity', entity, postgresql_using='gin'),
+    )
+
+    @validates('entity')
+    def validate_entity(self, key, entity):
+        self.set_entity_columns(entity)
+        return entity
+
+    def set_entity_columns(self, entity):
+        claims = entity['claims']
+        p18 = claims.get('P18')
+        try:
+            self.image_file = p18[0]['mainsnak']['datavalue']['value'] if p18 else None
+        except KeyError:
+            self.image_file = None
+
+        self.has_depicts = 'P180' in claims
+        artist = wikibase.first_datavalue(entity, 'P170')
+        self.artist_id = artist['numeric-id'] if artist else None
+        en = entity.get('labels', {}).get('en')
+        self.en_label = en['value'] if en else None
+        self.entity_label = wikibase.get_entity_label(entity)
+        inception = wikibase.first_datavalue(entity, 'P571')
+        if inception:
+            self.inception_year = utils.time_value_year(inception['time'])
+            self.inception_date = utils.format_time(inception['time'], inception['precision'])
+        else:
+            self.inception_year = self.inception_date = None
+
     def image_count(self):
         p18 = self.entity['claims'].get('P18')
         return len(p18) if p18 else 0
 
     def image_filename(self):
-        p18 = self.entity['claims'].get('P18')
-        if not p18:
-            return
-
-        try:
-            return p18[0]['mainsnak']['datavalue']['value']
-        except KeyError:
-            return
+        return self.image_file
 
     @property
     def label(self):
-        return wikibase.get_entity_label(self.entity)
+        return self.entity_label or wikibase.get_entity_label(self.entity)
 
     @property
     def artist(self):
-        v = wikibase.first_datavalue(self.entity, 'P170')
-        if not v:
-            return
-        return v['id']
+        if self.artist_id:
+            return f'Q{self.artist_id}'
 
     @property
     def depicts(self):
@@ -109,6 +141,30 @@ class Triple(Base):
 
     subject = relationship('Item', backref='triples')
 
+class FacetCount(Base):
+    ''' number of artworks with each predicate and object, built from triple '''
+    __tablename__ = 'facet_count'
+    predicate_id = Column(Integer, primary_key=True)
+    object_id = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False)
+    updated = Column(DateTime, nullable=False)
+
+class SubclassOf(Base):
+    ''' transitive closure of subclass of (P279), each class includes itself '''
+    __tablename__ = 'subclass_of'
+    class_id = Column(Integer, primary_key=True, autoincrement=False)
+    superclass_id = Column(Integer, primary_key=True, autoincrement=False, index=True)
+
+class Label(Base):
+    ''' item labels, a null label records that the item has none '''
+    __tablename__ = 'label'
+    item_id = Column(Integer, primary_key=True, autoincrement=False)
+    lang = Column(String, primary_key=True)
+    label = Column(String)
+    updated = Column(DateTime, default=now_utc(), nullable=False, index=True)
+
+    qid = column_property('Q' + cast(item_id, String))
+
 class HumanItem(Base):
     __tablename__ = 'human'
     item_id = Column(Integer, primary_key=True, autoincrement=False)
@@ -159,7 +215,7 @@ class Edit(Base):
 class WikidataQuery(Base):
     __tablename__ = 'wikidata_query'
     id = Column(Integer, primary_key=True)
-    start_time = Column(DateTime)
+    start_time = Column(DateTime, index=True)
     end_time = Column(DateTime)
     sparql_query = Column(String)
     path = Column(String)
@@ -181,10 +237,13 @@ class WikidataQuery(Base):
 
     @property
     def template(self):
-        if not self.query_template:
+        return self.short_template(self.query_template)
+
+    @staticmethod
+    def short_template(t):
+        if not t:
             return
 
-        t = self.query_template
         if t.startswith('query/'):
             t = t[6:]
         if t.endswith('.sparql'):
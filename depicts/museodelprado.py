@@ -2,6 +2,7 @@ import requests
 import lxml.html
 import os
 import re
+from . import utils, cache
 
 re_url = re.compile(r'www.museodelprado.es/(.+)$')
 
@@ -11,11 +12,11 @@ def get_html(url):
     filename = f'cache/museodelprado_{catalog_id}.html'
 
     if os.path.exists(filename):
-        html = open(filename).read()
+        html = cache.read_text(filename)
     else:
-        r = requests.get(url)
+        r = requests.get(utils.catalog_url(url))
         html = r.text
-        open(filename, 'w').write(html)
+        cache.write_text(filename, html)
 
     return html
 
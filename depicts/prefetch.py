@@ -0,0 +1,54 @@
+'''
+Warm the caches in the background for pages a user is likely to ask for next.
+
+Jobs run on a small thread pool shared by every request. When max_pending jobs
+are already waiting or running a new job is dropped rather than queued, and
+the same job is never queued twice. Requests made by a job give way to page
+views, see scheduler.background.
+'''
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import database, scheduler
+
+enabled = True
+max_workers = 2
+max_pending = 8
+
+# how many of the facet links with the most artworks to warm
+facet_links = 3
+
+executor = ThreadPoolExecutor(max_workers=max_workers)
+pending = set()
+pending_lock = threading.Lock()
+
+def init_app(app):
+    global enabled, max_workers, max_pending, facet_links, executor
+    config = app.config
+    enabled = config.get('PREFETCH', enabled)
+    max_workers = config.get('PREFETCH_WORKERS', max_workers)
+    max_pending = config.get('PREFETCH_MAX_PENDING', max_pending)
+    facet_links = config.get('PREFETCH_FACET_LINKS', facet_links)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+def submit(key, func, *args):
+    ''' run func(*args) in the background, returns False if the job was dropped '''
+    if not enabled:
+        return False
+    with pending_lock:
+        if key in pending or len(pending) >= max_pending:
+            return False
+        pending.add(key)
+    executor.submit(run, key, func, *args)
+    return True
+
+def run(key, func, *args):
+    try:
+        with scheduler.background():
+            func(*args)
+    except Exception as e:
+        print(f'prefetch {key!r} failed: {e!r}')
+    finally:
+        database.session.remove()
+        with pending_lock:
+            pending.discard(key)
@@ -0,0 +1,81 @@
+import os
+import time
+import queue
+import atexit
+import threading
+from . import database
+
+class QueryLog:
+    '''
+    buffer WikidataQuery rows and insert them from a background thread
+
+    A batch is written when it reaches max_batch rows or when the oldest row
+    has waited max_wait seconds.
+    '''
+
+    def __init__(self, max_batch=100, max_wait=5):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread_pid = None
+
+    def add(self, row):
+        self.start()
+        self.queue.put(row)
+
+    def start(self):
+        # threads don't survive fork, so each worker process starts its own
+        if self.thread_pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+            threading.Thread(target=self.run, daemon=True).start()
+            self.thread_pid = os.getpid()
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            self.write(self.next_batch())
+
+    def flush(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.write(batch)
+
+    def write(self, batch):
+        try:
+            database.session.bulk_save_objects(batch)
+            database.session.commit()
+        except Exception:
+            database.session.rollback()
+        finally:
+            database.session.remove()
+
+query_log = QueryLog()
+atexit.register(query_log.flush)
+
+def init_app(app):
+    query_log.max_batch = app.config.get('QUERY_LOG_BATCH_SIZE', 100)
+    query_log.max_wait = app.config.get('QUERY_LOG_FLUSH_SECONDS', 5)
+
+def add(row):
+    query_log.add(row)
@@ -2,6 +2,7 @@ import requests
 import lxml.html
 import os
 import re
+from . import utils, cache
 
 re_url = re.compile(r'^https://www.rijksmuseum.nl/(?:nl/collectie|en/collection)/([^/]+)$')
 
@@ -10,11 +11,11 @@ def get_html(catalog_id):
     en_url = 'https://www.rijksmuseum.nl/en/collection/' + catalog_id
 
     if os.path.exists(filename):
-        html = open(filename).read()
+        html = cache.read_text(filename)
     else:
-        r = requests.get(en_url)
+        r = requests.get(utils.catalog_url(en_url))
         html = r.text
-        open(filename, 'w').write(html)
+        cache.write_text(filename, html)
 
     return html
 
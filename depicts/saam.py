@@ -2,17 +2,18 @@ import requests
 import lxml.html
 import json
 import os
+from . import utils, cache
 
 def get_html(saam_id):
     filename = f'cache/saam_{saam_id}.html'
     url = 'http://americanart.si.edu/collections/search/artwork/'
 
     if os.path.exists(filename):
-        html = open(filename).read()
+        html = cache.read_text(filename)
     else:
-        r = requests.get(url, params={'id': saam_id})
+        r = requests.get(utils.catalog_url(url), params={'id': saam_id})
         html = r.text
-        open(filename, 'w').write(html)
+        cache.write_text(filename, html)
 
     return html
 
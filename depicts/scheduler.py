@@ -0,0 +1,128 @@
+'''
+Rate limiting for requests to Wikidata, Commons and WDQS.
+
+Every request waits for a token from the bucket for its host and user agent.
+Page views can use the whole bucket, background work (cache refreshes, CLI
+commands) only gets a token while the bucket is above a reserve, so it never
+holds up a page view.
+
+A reply that says the server is busy (HTTP 429 or 503, or a maxlag error)
+pauses the bucket for the Retry-After time and halves its rate. Each success
+adds a little back until the rate is at the configured limit again.
+'''
+
+import contextlib
+import contextvars
+import threading
+import time
+from urllib.parse import urlsplit
+
+# sent with background MediaWiki API calls, seconds of replication lag to tolerate
+maxlag = 5
+max_attempts = 4
+default_retry_after = 5
+
+# requests per second and burst size
+default_rate = (10, 20)
+host_rates = {
+    'query.wikidata.org': (2, 5),
+}
+min_rate = 0.2
+
+# fraction of the burst background requests leave for interactive requests
+background_reserve = 0.5
+
+buckets = {}
+buckets_lock = threading.Lock()
+
+is_background = contextvars.ContextVar('is_background', default=False)
+
+def init_app(app):
+    global maxlag, default_rate
+    maxlag = app.config.get('API_MAXLAG', maxlag)
+    default_rate = app.config.get('API_RATE_LIMIT', default_rate)
+    host_rates.update(app.config.get('API_HOST_RATE_LIMITS', {}))
+    buckets.clear()
+
+@contextlib.contextmanager
+def background():
+    ''' requests made in this block give way to interactive requests '''
+    token = is_background.set(True)
+    try:
+        yield
+    finally:
+        is_background.reset(token)
+
+def maxlag_params():
+    ''' maxlag for background requests, page views shouldn't fail on lag '''
+    return {'maxlag': maxlag} if is_background.get() else {}
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def take(self, background=False):
+        ''' take a token, or return how many seconds to wait before trying again '''
+        reserve = self.burst * background_reserve if background else 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.tokens >= 1 + reserve:
+                self.tokens -= 1
+                return 0
+            return (1 + reserve - self.tokens) / self.rate
+
+    def acquire(self, background=False):
+        while delay := self.take(background):
+            time.sleep(delay)
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def throttled(self, retry_after):
+        with self.lock:
+            self.rate = max(min_rate, self.rate / 2)
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+def get_bucket(url, user_agent=None):
+    host = urlsplit(url).netloc
+    key = (host, user_agent)
+    with buckets_lock:
+        if key not in buckets:
+            buckets[key] = TokenBucket(*host_rates.get(host, default_rate))
+        return buckets[key]
+
+def retry_after(r):
+    ''' seconds to wait if the reply says the server is busy, otherwise None '''
+    if r.status_code not in (429, 503) and r.headers.get('MediaWiki-API-Error') != 'maxlag':
+        return
+    try:
+        return max(0, float(r.headers.get('Retry-After', default_retry_after)))
+    except ValueError:  # an HTTP date, rare enough to use the default
+        return default_retry_after
+
+def request(send, url, user_agent=None, **kwargs):
+    ''' call send(url, **kwargs) once a token is free, retrying when throttled '''
+    bucket = get_bucket(url, user_agent)
+    for attempt in range(max_attempts):
+        bucket.acquire(is_background.get())
+        r = send(url, **kwargs)
+        wait = retry_after(r)
+        if wait is None:
+            bucket.success()
+            return r
+        bucket.throttled(wait)
+        if attempt + 1 < max_attempts:
+            r.close()
+    return r
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+'''
+Local stand-in for WDQS, the MediaWiki APIs and the museum catalog sites.
+
+Requests to /<host>/<path> are answered from recorded fixtures, keyed on the
+host, path and request parameters. With --record a miss is fetched from
+https://<host>/<path> and saved as a new fixture.
+
+Point the app at the stand-in with these config settings:
+
+    WDQS_URL = 'http://localhost:8000/query.wikidata.org/bigdata/namespace/wdq/sparql'
+    WIKIDATA_API_URL = 'http://localhost:8000/www.wikidata.org/w/api.php'
+    COMMONS_API_URL = 'http://localhost:8000/commons.wikimedia.org/w/api.php'
+    CATALOG_BASE_URL = 'http://localhost:8000'
+'''
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+import argparse
+import hashlib
+import base64
+import random
+import json
+import time
+import os
+import requests
+
+timeout_error = 'java.util.concurrent.TimeoutException'
+
+def fixture_key(host, path, params):
+    flat = '&'.join(f'{k}={v}' for k, v in sorted(params))
+    return hashlib.md5(f'{host}{path}?{flat}'.encode('utf-8')).hexdigest()
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def read_params(self):
+        split = urlsplit(self.path)
+        params = parse_qsl(split.query, keep_blank_values=True)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if body:
+            params += parse_qsl(body.decode('utf-8'), keep_blank_values=True)
+        host, _, path = split.path.lstrip('/').partition('/')
+        return host, '/' + path, params
+
+    def handle_request(self):
+        server = self.server
+        host, path, params = self.read_params()
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if random.random() < server.error_rate:
+            return self.send_error_response(host)
+
+        key = fixture_key(host, path, params)
+        filename = os.path.join(server.fixture_dir, host, key + '.json')
+        if os.path.exists(filename):
+            with open(filename) as f:
+                fixture = json.load(f)
+        elif server.record:
+            fixture = record(host, path, params, self.command, filename)
+        else:
+            return self.send_body(404, 'text/plain', b'no fixture\n')
+
+        self.send_body(fixture['status'],
+                       fixture['content_type'],
+                       base64.b64decode(fixture['body']))
+
+    def send_error_response(self, host):
+        if host == 'query.wikidata.org':
+            body = f'{timeout_error}\n'.encode('utf-8')
+            return self.send_body(500, 'text/plain', body)
+        self.send_body(503, 'text/plain', b'injected error\n')
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def record(host, path, params, method, filename):
+    url = f'https://{host}{path}'
+    if method == 'POST':
+        r = requests.post(url, data=params, timeout=60)
+    else:
+        r = requests.get(url, params=params, timeout=60)
+
+    fixture = {
+        'url': url,
+        'params': params,
+        'status': r.status_code,
+        'content_type': r.headers.get('Content-Type', 'application/octet-stream'),
+        'body': base64.b64encode(r.content).decode('ascii'),
+    }
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(fixture, f)
+    return fixture
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--fixtures', default='fixtures',
+                        help='directory holding recorded responses')
+    parser.add_argument('--record', action='store_true',
+                        help='fetch and save responses missing from the fixtures')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to wait before every response')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='extra random delay, up to this many seconds')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of requests that get an error response')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), StandInHandler)
+    server.fixture_dir = args.fixtures
+    server.record = args.record
+    server.latency = args.latency
+    server.jitter = args.jitter
+    server.error_rate = args.error_rate
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
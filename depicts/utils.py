@@ -2,7 +2,11 @@ from flask import request
 from itertools import islice
 from datetime import datetime
 import urllib.parse
+import codecs
 import inflect
+import dateutil.parser
+import json
+import re
 
 hosts = {
     'commons': 'commons.wikimedia.org',
@@ -11,6 +15,12 @@ hosts = {
 }
 
 engine = inflect.engine()
+json_decoder = json.JSONDecoder()
+re_whitespace_or_comma = re.compile(r'[\s,]*')
+re_time_value = re.compile(r'^([+-]?\d+)-\d\d-\d\dT')
+
+# set CATALOG_BASE_URL to send catalog site requests to a local stand-in
+catalog_base_url = None
 
 skip_names = {
     'National Gallery'
@@ -23,6 +33,48 @@ def chunk(it, size):
     it = iter(it)
     return iter(lambda: tuple(islice(it, size)), ())
 
+def iter_json_array(chunks, key):
+    '''
+    parse JSON arriving as a sequence of byte chunks and yield the items of
+    the first array stored under key, one at a time
+    '''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    re_start = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+    chunks = iter(chunks)
+    buf, pos = '', None
+
+    def read_more():
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError(f'JSON ended before end of {key!r} array')
+        return decoder.decode(chunk)
+
+    while pos is None:
+        buf += read_more()
+        m = re_start.search(buf)
+        if m:
+            pos = m.end()
+
+    while True:
+        pos = re_whitespace_or_comma.match(buf, pos).end()
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        try:
+            item, end = json_decoder.raw_decode(buf, pos)
+        except json.decoder.JSONDecodeError:
+            buf, pos = buf[pos:] + read_more(), 0
+            continue
+        yield item
+        pos = end
+
+def catalog_url(url):
+    ''' rewrite https://host/path as {catalog_base_url}/host/path '''
+    if not catalog_base_url:
+        return url
+    split = urllib.parse.urlsplit(url)
+    path = urllib.parse.urlunsplit(('', split.netloc, split.path, split.query, ''))
+    return catalog_base_url.rstrip('/') + path[1:]
+
 def drop_start(s, start):
     assert s.startswith(start)
     return s[len(start):]
@@ -79,6 +131,11 @@ def get_int_arg(name):
     if name in request.args and request.args[name].isdigit():
         return int(request.args[name])
 
+def time_value_year(value):
+    ''' year from a wikibase:timeValue, like 1889-01-01T00:00:00Z '''
+    m = re_time_value.match(value)
+    return int(m.group(1)) if m else dateutil.parser.parse(value).year
+
 def format_time(time_value, precision):
     # FIXME handle dates like '1965-04-00T00:00:00Z'
     # FIXME handle BC dates properly, "120 B.C." instead of "-120"
@@ -1,4 +1,4 @@
-from depicts import (wikibase, relaxed_ssl, saam, dia, rijksmuseum, npg,
+from depicts import (utils, cache, wikibase, relaxed_ssl, saam, dia, rijksmuseum, npg,
                      museodelprado, barnesfoundation)
 import requests
 import requests.exceptions
@@ -254,11 +254,11 @@ def get_catalog_page(property_id, value):
     filename = f'cache/{property_id}_{catalog_id}.html'
 
     if os.path.exists(filename):
-        html = open(filename, 'rb').read()
+        html = cache.read_bytes(filename)
     else:
-        r = requests.get(url, headers={'User-Agent': user_agent}, timeout=2)
+        r = requests.get(utils.catalog_url(url), headers={'User-Agent': user_agent}, timeout=2)
         html = r.content
-        open(filename, 'wb').write(html)
+        cache.write_bytes(filename, html)
 
     return html
 
@@ -267,12 +267,12 @@ def get_catalog_url(url):
     filename = 'cache/' + md5_filename
 
     if os.path.exists(filename):
-        html = open(filename, 'rb').read()
+        html = cache.read_bytes(filename)
     else:
-        r = relaxed_ssl.get(url,
+        r = relaxed_ssl.get(utils.catalog_url(url),
                             headers={'User-Agent': user_agent},
                             timeout=2)
         html = r.content
-        open(filename, 'wb').write(html)
+        cache.write_bytes(filename, html)
 
     return html
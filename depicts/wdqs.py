@@ -1,19 +1,39 @@
 import requests
-import json
 import urllib.parse
-import os
-import dateutil.parser
 import hashlib
-from flask import request, render_template, g
-from collections import defaultdict
+import time
+import threading
+import requests.exceptions
+from flask import request, render_template, g, has_request_context
 from datetime import datetime
-from .model import WikidataQuery
-from . import utils, database
+from sqlalchemy.dialects.postgresql import insert
+from .model import WikidataQuery, SubclassOf
+from . import utils, cache, query_log, database, scheduler, http_client
 
 query_url = 'https://query.wikidata.org/bigdata/namespace/wdq/sparql'
 url_start = 'http://www.wikidata.org/entity/Q'
 commons_start = 'http://commons.wikimedia.org/wiki/Special:FilePath/'
 
+cache_dir = 'cache/sparql'
+default_ttl = 7 * 24 * 3600  # one week
+template_ttl = {
+    'query/find_more.sparql': 24 * 3600,
+    'query/superclasses.sparql': 30 * 24 * 3600,
+}
+
+memory_max_bytes = 32 * 1024 * 1024
+memory_max_item_bytes = 1024 * 1024
+disk_max_bytes = 1024 ** 3
+
+memory_cache = cache.MemoryCache(memory_max_bytes, memory_max_item_bytes)
+disk_cache = cache.DiskCache(cache_dir, max_bytes=disk_max_bytes)
+query_lock = cache.KeyLock(cache_dir + '/lock')
+
+# serve expired results while a background thread refreshes them
+serve_stale = True
+refreshing = set()
+refreshing_lock = threading.Lock()
+
 class QueryError(Exception):
     def __init__(self, query, r):
         self.query = query
@@ -24,6 +44,56 @@ class QueryTimeout(QueryError):
         self.query = query
         self.r = r
 
+class CircuitOpen(QueryError):
+    def __init__(self, query):
+        self.query = query
+        self.r = None
+
+class CircuitBreaker:
+    '''
+    stop sending queries for cool_down seconds after max_failures errors in a row
+
+    Once the cool down is over a single trial query is let through. Success
+    closes the circuit, failure opens it for another cool down. If the trial
+    never reports back another one is allowed after cool_down seconds.
+    '''
+
+    def __init__(self, max_failures=3, cool_down=60):
+        self.max_failures = max_failures
+        self.cool_down = cool_down
+        self.failures = 0
+        self.opened = None
+        self.trial_started = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        ''' can a query be sent now? '''
+        with self.lock:
+            if self.opened is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened < self.cool_down:
+                return False
+            if self.trial_started is not None and now - self.trial_started < self.cool_down:
+                return False
+            self.trial_started = now
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial_started = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_started = None
+            if self.failures >= self.max_failures:
+                self.opened = time.monotonic()
+
+breaker = CircuitBreaker()
+
 def row_id(row, field='item'):
     return int(utils.drop_start(row[field]['value'], url_start))
 
@@ -45,155 +115,276 @@ def run_from_template_with_cache(template_name, cache_name=None, **context):
     query = render_template(template_name, **context)
     return run_query_with_cache(query, name=cache_name, query_template=template_name)
 
+def stream_from_template_with_cache(template_name, cache_name=None, **context):
+    query = render_template(template_name, **context)
+    return stream_query_with_cache(query, name=cache_name, query_template=template_name)
+
 def run_query(query, **kwargs):
     r, db_query = record_query(query, **kwargs)
+    query_log.add(db_query)
     return r
 
-def record_query(query, query_template=None):
+def request_info():
+    ''' details of the current request to store with the WikidataQuery row '''
+    if not has_request_context():
+        return {}
+    return {
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'page_title': getattr(g, 'title', None),
+    }
+
+def record_query(query, query_template=None, info=None):
+    '''
+    send query to WDQS
+
+    The WikidataQuery row is returned unsaved, the caller passes it to
+    query_log.add once the row count is known. Failed queries are logged here.
+    '''
     params = {'query': query, 'format': 'json'}
-    start = datetime.utcnow()
-
-    path = request.full_path.rstrip('?') if request else None
-    endpoint = request.endpoint if request else None
-
-    db_query = WikidataQuery(
-        start_time=start,
-        sparql_query=query,
-        path=path,
-        query_template=query_template,
-        page_title=getattr(g, 'title', None),
-        endpoint=endpoint)
-    database.session.add(db_query)
-    database.session.commit()
-
-    r = requests.post(query_url, data=params, stream=True)
+    if not breaker.allow():
+        raise CircuitOpen(params)
+
+    if info is None:
+        info = request_info()
+    db_query = WikidataQuery(start_time=datetime.utcnow(),
+                             sparql_query=query,
+                             query_template=query_template,
+                             **info)
+
+    try:
+        r = scheduler.request(requests.post, query_url, http_client.user_agent,
+                              data=params, stream=True,
+                              headers={'User-Agent': http_client.user_agent})
+    except requests.exceptions.RequestException:
+        breaker.failure()
+        raise
     db_query.end_time = datetime.utcnow()
     db_query.status_code = r.status_code
 
     if r.status_code != 200:
+        breaker.failure()
         db_query.error_text = r.text
-        database.session.commit()
+        query_log.add(db_query)
 
         if 'java.util.concurrent.TimeoutException' in r.text:
             raise QueryTimeout(params, r)
         else:
             raise QueryError(params, r)
 
-    database.session.commit()
+    breaker.success()
     return r, db_query
 
 def md5_query(query):
     ''' generate the md5 hexdigest of a SPARQL query '''
     return hashlib.md5(query.encode('utf-8')).hexdigest()
 
+def init_app(app):
+    global query_url, memory_cache, disk_cache, serve_stale
+    config = app.config
+    query_url = config.get('WDQS_URL', query_url)
+    template_ttl.update(config.get('SPARQL_CACHE_TTL', {}))
+    memory_cache = cache.MemoryCache(
+        config.get('SPARQL_CACHE_MEMORY_BYTES', memory_max_bytes),
+        config.get('SPARQL_CACHE_MEMORY_ITEM_BYTES', memory_max_item_bytes))
+    disk_cache = cache.DiskCache(cache_dir,
+                                 max_bytes=config.get('SPARQL_CACHE_MAX_BYTES', disk_max_bytes))
+    serve_stale = config.get('SPARQL_SERVE_STALE', True)
+    breaker.max_failures = config.get('WDQS_CIRCUIT_MAX_FAILURES', 3)
+    breaker.cool_down = config.get('WDQS_CIRCUIT_COOL_DOWN', 60)
+
+def get_ttl(query_template):
+    return template_ttl.get(query_template, default_ttl)
+
+def iter_bindings(r):
+    ''' parse a SPARQL JSON results stream, yielding one binding at a time '''
+    try:
+        yield from utils.iter_json_array(r.iter_content(chunk_size=64 * 1024),
+                                         'bindings')
+    finally:
+        r.close()
+
+def from_disk_cache(q, name):
+    ''' header and bindings for q from the disk cache, whatever their age '''
+    from_cache = disk_cache.get_rows(name)
+    if not from_cache:
+        return
+    header, rows = from_cache
+    if header.get('query') == q:
+        return header, rows
+    rows.close()
+
+def use_cached(header, q, name, query_template):
+    ''' should this cache entry be served? stale entries are refreshed in the background '''
+    if cache.is_fresh(header, get_ttl(query_template)):
+        return True
+    if not serve_stale:
+        return False
+    start_refresh(q, name, query_template)
+    return True
+
+def start_refresh(q, name, query_template):
+    with refreshing_lock:
+        if name in refreshing:
+            return
+        refreshing.add(name)
+
+    args = (q, name, query_template, request_info())
+    threading.Thread(target=refresh, args=args, daemon=True).start()
+
+def refresh(q, name, query_template, info):
+    try:
+        with scheduler.background():
+            for row in fetch_with_cache(q, name, query_template, info=info):
+                pass
+        # the next read takes the new rows from the disk cache
+        memory_cache.delete(name)
+    except (QueryError, requests.exceptions.RequestException):
+        pass  # keep serving the stale result
+    finally:
+        with refreshing_lock:
+            refreshing.discard(name)
+
+def fetch_with_cache(q, name, query_template, info=None):
+    ''' run the query and write the bindings to the disk cache as they arrive '''
+
+    # identical queries from other threads and workers wait here, then
+    # read the result from the disk cache
+    with query_lock(name):
+        from_cache = from_disk_cache(q, name)
+        if from_cache and cache.is_fresh(from_cache[0], get_ttl(query_template)):
+            yield from from_cache[1]
+            return
+
+        r, db_query = record_query(q, query_template=query_template, info=info)
+        header = {'query': q, 'timestamp': time.time()}
+        row_count = 0
+        try:
+            for row in disk_cache.set_rows(name, header, iter_bindings(r)):
+                row_count += 1
+                yield row
+            db_query.row_count = row_count
+        finally:
+            query_log.add(db_query)
+
+def stream_query_with_cache(q, name=None, query_template=None):
+    ''' yield bindings from the cache or as they arrive from WDQS '''
+    if name is None:
+        name = md5_query(q)
+
+    from_cache = memory_cache.get(name)
+    if (from_cache and from_cache['query'] == q and
+            use_cached(from_cache, q, name, query_template)):
+        yield from from_cache['bindings']
+        return
+
+    from_cache = from_disk_cache(q, name)
+    if from_cache and use_cached(from_cache[0], q, name, query_template):
+        yield from from_cache[1]
+        return
+
+    yield from fetch_with_cache(q, name, query_template)
+
 def run_query_with_cache(q, name=None, query_template=None):
     if name is None:
         name = md5_query(q)
-    filename = f'cache/{name}.json'
-    if os.path.exists(filename):
-        from_cache = json.load(open(filename))
-        if isinstance(from_cache, dict) and from_cache.get('query') == q:
-            return from_cache['bindings']
-
-    r, db_query = record_query(q, query_template=query_template)
-    bindings = r.json()['results']['bindings']
-    json.dump({'query': q, 'bindings': bindings},
-              open(filename, 'w'), indent=2)
-
-    db_query.row_count = len(bindings)
-    database.session.commit()
+
+    from_cache = memory_cache.get(name)
+    if (from_cache and from_cache['query'] == q and
+            use_cached(from_cache, q, name, query_template)):
+        return from_cache['bindings']
+
+    from_cache = from_disk_cache(q, name)
+    if from_cache and use_cached(from_cache[0], q, name, query_template):
+        header, rows = from_cache
+        timestamp = header['timestamp']
+        bindings = list(rows)
+    else:
+        timestamp = time.time()
+        bindings = list(fetch_with_cache(q, name, query_template))
+
+    memory_cache.set(name, {'query': q, 'bindings': bindings, 'timestamp': timestamp})
     return bindings
 
 def format_time(row_time, row_timeprecision):
-    t = dateutil.parser.parse(row_time['value'])
+    year = utils.time_value_year(row_time['value'])
     precision = int(row_timeprecision['value'])
 
     if precision == 9:
-        return t.year
+        return year
     if precision == 8:
-        return f'{t.year}s'
+        return f'{year}s'
     if precision == 7:
-        return f'{utils.ordinal((t.year // 100) + 1)} century'
+        return f'{utils.ordinal((year // 100) + 1)} century'
     if precision == 6:
-        return f'{utils.ordinal((t.year // 1000) + 1)} millennium'
+        return f'{utils.ordinal((year // 1000) + 1)} millennium'
 
     return row_time['value']
 
-def build_browse_item_map(bindings):
-    row_map = defaultdict(list)
+class BrowseItem:
+    ''' aggregate the rows for one artwork, dicts are used as ordered sets '''
 
-    for row in bindings:
-        item_id = row_id(row)
-        label = row['itemLabel']['value']
-        image_filename = commons_uri_to_filename(row['image']['value'])
+    __slots__ = ('item_id', 'filenames', 'artist_names', 'labels', 'en_title',
+                 'date', 'depicts')
 
-        artist_name = get_row_value(row, 'artistLabel')
+    def __init__(self, item_id):
+        self.item_id = item_id
+        self.filenames = {}
+        self.artist_names = {}
+        self.labels = set()
+        self.en_title = None
+        self.date = None
+        self.depicts = {}
 
-        d = format_time(row['time'], row['timeprecision']) if 'time' in row else None
-        row_qid = f'Q{item_id}'
+    def add_row(self, row):
+        self.filenames[commons_uri_to_filename(row['image']['value'])] = None
 
-        item = {
-            'image_filename': image_filename,
-            'date': d,
-            'depicts': row['depictsList']['value'].split('|'),
-        }
+        artist_name = get_row_value(row, 'artistLabel')
         if artist_name:
-            item['artist_name'] = artist_name
-        if label != row_qid:
-            item['label'] = label
+            self.artist_names[artist_name] = None
+
+        label = row['itemLabel']['value']
+        if label != f'Q{self.item_id}':
+            self.labels.add(label)
+
+        if not self.date and 'time' in row:
+            self.date = format_time(row['time'], row['timeprecision'])
 
         title = get_row_value(row, 'title')
-        if title:
-            lang = get_row_value(row, 'titleLang')
-            item['title'] = (lang, title)
-
-        row_map[item_id].append(item)
-
-    item_map = {}
-    for item_id, items in row_map.items():
-        titles = {}
-        filenames = set()
-        artist_names = []
-        labels = set()
-        when = None
-        depicts = []
-        for item in items:
-            if 'title' in item:
-                lang, title = item['title']
-                titles[lang] = title
-            filenames.add(item['image_filename'])
-            artist_name = item.get('artist_name')
-            if artist_name and artist_name not in artist_names:
-                artist_names.append(artist_name)
-            if 'label' in item:
-                labels.add(item['label'])
-            if when is None and item.get('date'):
-                when = item['date']
-            for d in item['depicts']:
-                if d not in depicts:
-                    depicts.append(d)
+        if title and get_row_value(row, 'titleLang') == 'en':
+            self.en_title = title
 
+        self.depicts.update(dict.fromkeys(row['depictsList']['value'].split('|')))
+
+    def as_dict(self):
         item = {
-            'qid': f'Q{item_id}',
-            'item_id': item_id,
-            'image_filename': list(filenames),
-            'artist_name': ', '.join(artist_names),
-            'date': when,
-            'depicts': depicts,
+            'qid': f'Q{self.item_id}',
+            'item_id': self.item_id,
+            'image_filename': list(self.filenames),
+            'artist_name': ', '.join(self.artist_names),
+            'date': self.date,
+            'depicts': list(self.depicts),
         }
-        if artist_names:
-            item['artist_name'] = ', '.join(artist_names)
-        if labels:
-            assert len(labels) == 1
-            item['label'] = list(labels)[0]
-        elif 'en' in titles:
-            item['label'] = titles['en']
+        if self.labels:
+            assert len(self.labels) == 1
+            item['label'] = next(iter(self.labels))
+        elif self.en_title:
+            item['label'] = self.en_title
         else:
             item['label'] = '[ label missing ]'
 
-        item_map[item_id] = item
+        return item
+
+def build_browse_item_map(bindings):
+    items = {}
+    for row in bindings:
+        item_id = row_id(row)
+        item = items.get(item_id)
+        if item is None:
+            item = items[item_id] = BrowseItem(item_id)
+        item.add_row(row)
 
-    return item_map
+    return {item_id: item.as_dict() for item_id, item in items.items()}
 
 def quote_list(l):
     no_dups = list(dict.fromkeys(l))  # remove duplicates
@@ -203,8 +394,64 @@ def url_list(l):
     no_dups = list(dict.fromkeys(l))  # remove duplicates
     return ' '.join(f'(<{s}>)' for s in no_dups)
 
-def is_artificial_physical_object(qid):
-    bindings = run_from_template_with_cache('query/item_type.sparql', qid=qid)
-    types = {row_id(row, field='item') for row in bindings}
+def fetch_superclasses(class_ids, cached=True):
+    ''' set of (class_id, superclass_id) from WDQS, each class includes itself '''
+    rows = set()
+    for cur in utils.chunk(class_ids, 50):
+        qid_list = [f'Q{i}' for i in cur]
+        if cached:
+            bindings = run_from_template_with_cache('query/superclasses.sparql',
+                                                    qid_list=qid_list)
+        else:
+            r = run_from_template('query/superclasses.sparql', qid_list=qid_list)
+            bindings = iter_bindings(r)
+        rows.update((class_id, class_id) for class_id in cur)
+        rows.update((row_id(row, field='class'), row_id(row, field='item'))
+                    for row in bindings)
+    return rows
+
+def save_superclasses(rows):
+    for cur in utils.chunk(rows, 1000):
+        values = [{'class_id': class_id, 'superclass_id': superclass_id}
+                  for class_id, superclass_id in cur]
+        database.session.execute(insert(SubclassOf.__table__)
+                                 .values(values)
+                                 .on_conflict_do_nothing())
+
+def load_superclasses(class_ids):
+    ''' add classes missing from the subclass_of table, using WDQS '''
+    known = {class_id for class_id, in
+             database.session.query(SubclassOf.class_id)
+                             .filter(SubclassOf.class_id.in_(class_ids))
+                             .distinct()}
+    missing = sorted(set(class_ids) - known)
+    if missing:
+        save_superclasses(fetch_superclasses(missing))
+        database.session.commit()
+
+def refresh_superclasses():
+    '''
+    reload the closure for every class in the subclass_of table, straight
+    from WDQS, the cached results could be a month old
+    '''
+    class_ids = sorted(class_id for class_id, in
+                       database.session.query(SubclassOf.class_id).distinct())
+    rows = fetch_superclasses(class_ids, cached=False)
+    SubclassOf.query.delete()
+    save_superclasses(rows)
+    database.session.commit()
+
+def is_subclass(class_ids, superclass_id):
+    if not class_ids:
+        return False
+    load_superclasses(class_ids)
+    q = SubclassOf.query.filter(SubclassOf.class_id.in_(class_ids),
+                                SubclassOf.superclass_id == superclass_id)
+    return database.session.query(q.exists()).scalar()
+
+def is_artificial_physical_object(entity):
+    instance_of = [claim['mainsnak']['datavalue']['value']['numeric-id']
+                   for claim in entity['claims'].get('P31', [])
+                   if 'datavalue' in claim['mainsnak']]
     # Q8205328 == artificial physical object
-    return 8205328 in types
+    return is_subclass(instance_of, 8205328)